@@ -0,0 +1,73 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+from plan_view import exr_io
+
+# Network outputs accumulated into a plan-view raster (H x W x classes), the
+# inverse of the label lookup in dataloader.load_files. Voxel centers are
+# projected with the floor plan projection matrix and every class score is
+# scattered into its pixel with one bincount per class.
+#
+#   VOTES          count of voxels predicting each class
+#   LOGITS         sum of raw network outputs
+#   PROBABILITIES  sum of softmax probabilities
+#
+# With normalize, sums are divided by the number of voxels in the pixel.
+
+VOTES = "votes"
+LOGITS = "logits"
+PROBABILITIES = "probabilities"
+
+def softmax(logits):
+    exponentials = np.exp(logits - np.max(logits, axis=1, keepdims=True))
+    return exponentials / np.sum(exponentials, axis=1, keepdims=True)
+
+def project_voxels(coords, voxel_size, projection_matrix, width, height):
+    # Returns the flat pixel index (v * width + u) of every voxel that lands
+    # inside the raster, and the mask of those voxels.
+    centers = (np.asarray(coords[:, 0:3], dtype=np.float64) + 0.5) * voxel_size
+    uv = np.matmul(centers, projection_matrix[0:2, 0:3].transpose()) + projection_matrix[0:2, 3]
+    pixels = np.floor(uv * np.array([width, height])).astype(np.int64)
+
+    valid = (pixels[:, 0] >= 0) & (pixels[:, 0] < width) & (pixels[:, 1] >= 0) & (pixels[:, 1] < height)
+    pixels = pixels[valid]
+
+    return pixels[:, 1] * width + pixels[:, 0], valid
+
+def back_project(coords, scores, voxel_size, projection_matrix, width, height, mode=PROBABILITIES, normalize=True):
+    scores = np.asarray(scores, dtype=np.float32)
+    num_pixels = width * height
+    _, num_classes = scores.shape
+
+    pixel_indices, valid = project_voxels(coords, voxel_size, projection_matrix, width, height)
+    scores = scores[valid]
+
+    counts = np.bincount(pixel_indices, minlength=num_pixels)
+
+    if mode == VOTES:
+        predictions = np.argmax(scores, axis=1)
+        raster = np.bincount(pixel_indices * num_classes + predictions, minlength=num_pixels * num_classes).astype(np.float32)
+        raster = raster.reshape((num_pixels, num_classes))
+    elif mode in (LOGITS, PROBABILITIES):
+        if mode == PROBABILITIES:
+            scores = softmax(scores)
+
+        raster = np.empty((num_pixels, num_classes), dtype=np.float32)
+        for channel in range(num_classes):
+            raster[:, channel] = np.bincount(pixel_indices, weights=scores[:, channel], minlength=num_pixels)
+    else:
+        raise ValueError("Unknown back projection mode {}".format(mode))
+
+    if normalize:
+        raster /= np.maximum(counts, 1)[:, np.newaxis]
+
+    return raster.reshape((height, width, num_classes)), counts.reshape((height, width))
+
+def write_back_projection(output_file, coords, scores, voxel_size, projection_matrix, width, height, mode=PROBABILITIES, normalize=True):
+    raster, _ = back_project(coords, scores, voxel_size, projection_matrix, width, height, mode, normalize)
+    exr_io.write_semantic_image(output_file, raster)
+
+    return raster
@@ -0,0 +1,92 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import copy
+import time
+
+import torch
+import torch.nn as nn
+
+from plan_view.benchmark_precision import synthetic_scene
+from plan_view.dataloader import input_tensor_to_device, make_input_sparse_tensor
+from plan_view.train import CHECKPOINT_ALL, CHECKPOINT_DECODER, CHECKPOINT_ENCODER, CHECKPOINT_NONE, MinkUNet34C
+
+# Compares MinkUNet34C training steps with and without activation checkpointing
+# on a synthetic batch: gradients and batch norm statistics must match, peak
+# memory (CUDA only) and step time are reported per policy.
+
+POLICIES = {
+    "none": CHECKPOINT_NONE,
+    "encoder": CHECKPOINT_ENCODER,
+    "decoder": CHECKPOINT_DECODER,
+    "all": CHECKPOINT_ALL
+}
+
+def train_step(net, prepared_examples, device):
+    criterion = nn.CrossEntropyLoss()
+
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+
+    start_time = time.time()
+
+    input_tensor, labels = make_input_sparse_tensor(prepared_examples)
+    input = input_tensor_to_device(input_tensor, device)
+    output = net(input)
+    loss = criterion(output.F, labels.to(device))
+    loss.backward()
+
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+    elapsed = time.time() - start_time
+    peak_memory = torch.cuda.max_memory_allocated() if device.type == "cuda" else None
+
+    return loss.item(), elapsed, peak_memory
+
+def run(num_points, num_scenes, voxel_size):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    prepared_examples = [synthetic_scene(num_points, voxel_size, seed) for seed in range(num_scenes)]
+    print("Synthetic batch: {} scenes, {} voxels on {}".format(num_scenes, sum(coords.shape[0] for coords, _, _ in prepared_examples), device))
+
+    torch.manual_seed(0)
+    reference_net = MinkUNet34C(in_channels=5, out_channels=4, D=3)
+    results = {}
+
+    for name, policy in POLICIES.items():
+        net = copy.deepcopy(reference_net)
+        net.checkpoint_blocks = policy
+        net = net.to(device).train()
+
+        loss, elapsed, peak_memory = train_step(net, prepared_examples, device)
+        results[name] = net
+
+        print("{:<8} loss {:.6f}, {:.2f}s{}".format(name, loss, elapsed, ", peak memory {:.0f} MB".format(peak_memory / 1024 ** 2) if peak_memory is not None else ""))
+
+    reference_parameters = dict(results["none"].named_parameters())
+    reference_buffers = dict(results["none"].named_buffers())
+
+    for name, net in results.items():
+        for parameter_name, parameter in net.named_parameters():
+            assert torch.allclose(parameter.grad, reference_parameters[parameter_name].grad, rtol=1e-4, atol=1e-5), (name, parameter_name)
+
+        # Running statistics within tolerance, batch counts exactly
+        for buffer_name, buffer in net.named_buffers():
+            if buffer.dtype.is_floating_point:
+                assert torch.allclose(buffer, reference_buffers[buffer_name], rtol=1e-5, atol=1e-6), (name, buffer_name)
+            else:
+                assert torch.equal(buffer, reference_buffers[buffer_name]), (name, buffer_name)
+
+    print("Gradients and batch norm statistics match for all policies")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_points", type=int, default=400000)
+    parser.add_argument("--num_scenes", type=int, default=2)
+    parser.add_argument("--voxel_size", type=float, default=0.08)
+    args = parser.parse_args()
+
+    run(args.num_points, args.num_scenes, args.voxel_size)
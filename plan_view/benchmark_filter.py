@@ -0,0 +1,108 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+
+from plan_view.dataloader import build_adjacency_graph, min_distances_from_scan_locations, nearby_point_edges
+
+# Microbenchmark for the pure numpy / scipy parts of filter_by_connected_components
+# on a synthetic cloud. The KD-tree triplet search (pupil_vision.find_triplets) is
+# replaced by a synthetic neighbour graph of the same shape, [N * max_nn, 3].
+
+def legacy_min_distances(points, scan_origins):
+    num_points, _ = points.shape
+    origins = np.expand_dims(np.transpose(np.array(scan_origins), axes=[1, 0]), axis=0)
+    tiled_points = np.expand_dims(points, axis=2)
+
+    max_batch_size = 100000
+    num_batches = int(np.ceil(float(num_points) / float(max_batch_size)))
+    min_distances = np.zeros((num_points,), dtype = np.float32)
+    for batch_index in range(num_batches):
+        batch_start = batch_index * max_batch_size
+        batch_end = batch_start + min(max_batch_size, num_points - batch_start)
+        distances = np.linalg.norm(origins - tiled_points[batch_start:batch_end, ...], axis=1, ord=2)
+        min_distances[batch_start:batch_end] = np.min(distances, axis=1)
+
+    return min_distances
+
+def legacy_nearby_point_triplets(min_distances, max_num_nearby_points):
+    sorted_point_indices = np.argsort(min_distances)
+
+    nearby_point_triplet_list = []
+    num_nearby_points = min(max_num_nearby_points, sorted_point_indices.shape[0])
+    for index in range(num_nearby_points):
+        for pair_index in range(index + 1, num_nearby_points):
+            if sorted_point_indices[index] > sorted_point_indices[pair_index]:
+                nearby_point_triplet_list.append([sorted_point_indices[index], sorted_point_indices[pair_index], 1])
+            else:
+                nearby_point_triplet_list.append([sorted_point_indices[pair_index], sorted_point_indices[index], 1])
+
+    return np.array(nearby_point_triplet_list, dtype = np.int32)
+
+def legacy_components(triplets, num_points):
+    graph = scipy.sparse.coo_matrix((triplets[:, 2], (triplets[:, 0], triplets[:, 1])), shape=(num_points, num_points))
+    return scipy.sparse.csgraph.connected_components(graph, directed = False)
+
+def synthetic_cloud(num_points, num_scans, max_nn, seed=0):
+    random_state = np.random.RandomState(seed)
+    points = random_state.uniform(-20.0, 20.0, size=(num_points, 3))
+    scan_origins = [random_state.uniform(-15.0, 15.0, size=(3,)) for _ in range(num_scans)]
+
+    # Neighbour triplets laid out like the KD-tree output: max_nn per point,
+    # grouped by the query point, with a few dropped to create extra components.
+    rows = np.repeat(np.arange(num_points, dtype=np.int32), max_nn)
+    cols = np.clip(rows + random_state.randint(1, 64, size=rows.shape).astype(np.int32), 0, num_points - 1)
+    keep = random_state.uniform(size=rows.shape) > 0.05
+    triplets = np.stack([rows[keep], cols[keep], np.ones_like(rows[keep])], axis=1)
+
+    return points, scan_origins, triplets
+
+def timed(func, *args):
+    start_time = time.time()
+    result = func(*args)
+    return result, time.time() - start_time
+
+def run(num_points, num_scans, max_nn, max_num_nearby_points):
+    points, scan_origins, triplets = synthetic_cloud(num_points, num_scans, max_nn)
+    print("Synthetic cloud: {} points, {} scans, {} neighbour triplets".format(num_points, num_scans, triplets.shape[0]))
+
+    legacy_distances, legacy_time = timed(legacy_min_distances, points, scan_origins)
+    distances, new_time = timed(min_distances_from_scan_locations, points, scan_origins)
+    assert np.allclose(legacy_distances, distances, atol=1e-4)
+    print("min distances:        legacy {:.3f}s, vectorized {:.3f}s".format(legacy_time, new_time))
+
+    legacy_triplets, legacy_time = timed(legacy_nearby_point_triplets, distances, max_num_nearby_points)
+    (nearby_rows, nearby_cols), new_time = timed(nearby_point_edges, distances, max_num_nearby_points)
+    print("nearby points:        legacy {:.3f}s ({} edges), vectorized {:.5f}s ({} edges)".format(legacy_time, legacy_triplets.shape[0], new_time, nearby_rows.shape[0]))
+
+    all_triplets = np.concatenate([triplets, legacy_triplets], axis=0)
+    (_, legacy_labels), legacy_time = timed(legacy_components, all_triplets, num_points)
+
+    def components():
+        rows = np.concatenate([triplets[:, 0], nearby_rows])
+        cols = np.concatenate([triplets[:, 1], nearby_cols])
+        graph = build_adjacency_graph(rows, cols, num_points)
+        return scipy.sparse.csgraph.connected_components(graph, directed = False)
+
+    (_, labels), new_time = timed(components)
+    print("connected components: legacy {:.3f}s, vectorized {:.3f}s".format(legacy_time, new_time))
+
+    # Same partition of the points, up to a relabelling of the components.
+    num_pairs = np.unique(legacy_labels.astype(np.int64) * (labels.max() + 1) + labels).shape[0]
+    assert num_pairs == legacy_labels.max() + 1 == labels.max() + 1
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_points", type=int, default=4000000)
+    parser.add_argument("--num_scans", type=int, default=30)
+    parser.add_argument("--max_nn", type=int, default=10)
+    parser.add_argument("--max_num_nearby_points", type=int, default=300)
+    args = parser.parse_args()
+
+    run(args.num_points, args.num_scans, args.max_nn, args.max_num_nearby_points)
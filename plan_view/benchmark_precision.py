@@ -0,0 +1,135 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import copy
+import shutil
+import tempfile
+
+import MinkowskiEngine as ME
+import numpy as np
+import torch
+import torch.nn as nn
+
+from torch.optim import SGD
+
+from plan_view.dataloader import input_tensor_to_device, make_input_sparse_tensor
+from plan_view.example_cache import ExampleCache
+from plan_view.train import MinkUNet34C
+
+# CPU check of the half precision feature path (make_input_sparse_tensor with
+# feature_dtype=torch.float16, then input_tensor_to_device) against float32,
+# on synthetic scenes shaped like prepare_example output.
+#
+# The only numerical difference allowed is the rounding of the stored features
+# to float16: the float32 path fed with pre-rounded features must train
+# identically, and the plain float32 path must stay close.
+#
+# Host memory is reported as the feature bytes alive while a batch is
+# collated: the per scene arrays it is built from plus the batch tensor.
+
+def synthetic_scene(num_points, voxel_size, seed):
+    random_state = np.random.RandomState(seed)
+
+    points = random_state.uniform(low=[0.0, 0.0, 0.0], high=[12.0, 9.0, 2.5], size=(num_points, 3))
+    normals = random_state.normal(size=(num_points, 3))
+    normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+    intensities = random_state.uniform(-1.0, 1.0, size=(num_points, 1))
+    distances = np.linalg.norm(points - np.array([6.0, 4.5, 1.5]), axis=1, keepdims=True)
+    labels = random_state.randint(0, 4, size=(num_points,))
+
+    features = np.concatenate([intensities, normals, distances], axis=1).astype(np.float32)
+    quantized_coords = np.floor(points / voxel_size)
+    indices = ME.utils.sparse_quantize(quantized_coords)
+
+    return quantized_coords[indices], features[indices], labels[indices]
+
+def round_features(prepared_examples):
+    return [(coords, features.astype(np.float16).astype(np.float32), labels) for coords, features, labels in prepared_examples]
+
+def train_steps(net, prepared_examples, feature_dtype, num_steps):
+    criterion = nn.CrossEntropyLoss()
+    optimizer = SGD(net.parameters(), lr=1e-2)
+    device = torch.device("cpu")
+    losses = []
+    outputs = []
+
+    for _ in range(num_steps):
+        optimizer.zero_grad()
+
+        input_tensor, labels = make_input_sparse_tensor(prepared_examples, feature_dtype)
+        input = input_tensor_to_device(input_tensor, device)
+
+        output = net(input)
+        loss = criterion(output.F, labels)
+        loss.backward()
+        optimizer.step()
+
+        losses.append(loss.item())
+        outputs.append(output.F.detach().clone())
+
+    return np.array(losses), outputs
+
+def cached_examples(prepared_examples, cache_dir):
+    # Round trip through an ExampleCache storing float16 features, as
+    # DataLoader.iterator(cache_dir=..., feature_dtype=torch.float16) does.
+    cache = ExampleCache(cache_dir, np.float16)
+    for index, prepared_example in enumerate(prepared_examples):
+        cache.store("scene{}".format(index), prepared_example)
+
+    return [cache.load("scene{}".format(index))[1] for index in range(len(prepared_examples))]
+
+def host_feature_bytes(prepared_examples, feature_dtype):
+    scene_bytes = sum(features.nbytes for _, features, _ in prepared_examples)
+    input_tensor, _ = make_input_sparse_tensor(prepared_examples, feature_dtype)
+
+    return scene_bytes, input_tensor.F.element_size() * input_tensor.F.nelement()
+
+def run(num_points, num_scenes, num_steps, voxel_size):
+    prepared_examples = [synthetic_scene(num_points, voxel_size, seed) for seed in range(num_scenes)]
+    num_voxels = sum(coords.shape[0] for coords, _, _ in prepared_examples)
+    print("Synthetic batch: {} scenes, {} voxels".format(num_scenes, num_voxels))
+
+    torch.manual_seed(0)
+    net = MinkUNet34C(in_channels=5, out_channels=4, D=3)
+
+    float32_losses, float32_outputs = train_steps(copy.deepcopy(net), prepared_examples, None, num_steps)
+    rounded_losses, rounded_outputs = train_steps(copy.deepcopy(net), round_features(prepared_examples), None, num_steps)
+    half_losses, half_outputs = train_steps(copy.deepcopy(net), prepared_examples, torch.float16, num_steps)
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        half_prepared_examples = cached_examples(prepared_examples, cache_dir)
+        cached_losses, _ = train_steps(copy.deepcopy(net), half_prepared_examples, torch.float16, num_steps)
+
+        # Identical up to the rounding of the inputs
+        assert np.array_equal(rounded_losses, half_losses)
+        assert np.array_equal(rounded_losses, cached_losses)
+        assert all(torch.allclose(rounded_output, half_output, atol=1e-6) for rounded_output, half_output in zip(rounded_outputs, half_outputs))
+
+        host_bytes = [
+            ("float32", host_feature_bytes(prepared_examples, None)),
+            ("float16 batch", host_feature_bytes(prepared_examples, torch.float16)),
+            ("float16 cache", host_feature_bytes(half_prepared_examples, torch.float16))
+        ]
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    # Close to the float32 path
+    assert np.allclose(float32_losses, half_losses, rtol=1e-2)
+    print("losses float32 {}, float16 features {}".format(np.round(float32_losses, 5).tolist(), np.round(half_losses, 5).tolist()))
+    print("max output difference to float32: {:.2e}".format(max((float32_output - half_output).abs().max().item() for float32_output, half_output in zip(float32_outputs, half_outputs))))
+
+    for name, (scene_bytes, batch_bytes) in host_bytes:
+        print("{:<14} host feature memory: scenes {:.1f} MB + batch {:.1f} MB = {:.0f} bytes per voxel".format(name, scene_bytes / 1024 ** 2, batch_bytes / 1024 ** 2, (scene_bytes + batch_bytes) / num_voxels))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_points", type=int, default=200000)
+    parser.add_argument("--num_scenes", type=int, default=2)
+    parser.add_argument("--num_steps", type=int, default=3)
+    parser.add_argument("--voxel_size", type=float, default=0.08)
+    args = parser.parse_args()
+
+    run(args.num_points, args.num_scenes, args.num_steps, args.voxel_size)
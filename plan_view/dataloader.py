@@ -9,10 +9,14 @@ import MinkowskiEngine as ME
 import numpy as np
 import os
 import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.spatial
 import matplotlib.pyplot as plt
 
-from plan_view import exr_io, svg_parser
-from pupil import io
+from plan_view import exr_io, floor_plan_raster, point_cloud_store
+from plan_view.example_cache import ExampleCache
+from plan_view.prefetch import prefetch
+from pupil import io, profiler
 
 from plan_view.get_colormaps import create_generic_colormap
 import torch
@@ -87,6 +91,9 @@ class Example:
         yield self.floor_plan
         yield self.label
 
+def scene_name(example):
+    return os.path.splitext(os.path.basename(example.merged_pointloud))[0]
+
 class DataLoader:
     def __init__(self, execution_id, work_dir, num_shards=1):
         self.execution_id = execution_id
@@ -108,9 +115,15 @@ class DataLoader:
 
         response = []
 
-        for registration_response_reference, plan_view_label_response_reference in zip(registration_task["responses"][:self.num_shards], plan_view_label_generation_task["responses"][:self.num_shards]):
-            registration_response = io.load_json_from_s3(**registration_response_reference)
-            plan_view_label_response = io.load_json_from_s3(**plan_view_label_response_reference)
+        registration_response_references = registration_task["responses"][:self.num_shards]
+        plan_view_label_response_references = plan_view_label_generation_task["responses"][:self.num_shards]
+
+        # Fetch every shard of both tasks concurrently instead of two round-trips per shard
+        shard_responses = io.load_jsons_from_s3(registration_response_references + plan_view_label_response_references)
+        registration_responses = shard_responses[:len(registration_response_references)]
+        plan_view_label_responses = shard_responses[len(registration_response_references):]
+
+        for registration_response, plan_view_label_response in zip(registration_responses, plan_view_label_responses):
 
             _local_cache = {}
 
@@ -187,121 +200,107 @@ class DataLoader:
         for example in self.examples:
             io.download_assets(example.asset_iterator)
 
-    def savePointClouds(self):
+    def savePointClouds(self, num_workers=None):
+        from plan_view.merge_point_clouds import merge_point_clouds
+
+        merge_point_clouds(self.examples, num_workers)
+
+    def iterator(self, voxel_size=0.08, num_epochs=5, num_workers=0, max_pending=None, cache_dir=None, batch_size=1, max_voxels_per_batch=None, feature_dtype=None, start_position=0, with_positions=False):
+        # The position of a batch is the number of examples of the (epoch
+        # repeated) stream consumed up to and including its last scene. Batches
+        # are packed greedily from where the previous one ended, so starting
+        # at a position reproduces the batches that followed it.
+        # With feature_dtype, the cache stores the features in that precision.
+        cache = ExampleCache(cache_dir, numpy_dtype(feature_dtype)) if cache_dir is not None else None
+        examples = itertools.islice(itertools.chain.from_iterable(itertools.repeat(self.examples, num_epochs)), start_position, None)
+        prepared_examples = prefetch(prepare_example, ((example, voxel_size, cache) for example in examples), num_workers, max_pending)
+        positioned_examples = (tuple(prepared_example) + (start_position + index + 1,) for index, prepared_example in enumerate(prepared_examples) if prepared_example is not None)
+
+        for batch in batch_iterator(positioned_examples, batch_size, max_voxels_per_batch):
+            with profiler.span("collate") as collate_span:
+                input_tensor, labels = make_input_sparse_tensor([prepared_example[0:3] for prepared_example in batch], feature_dtype)
+                collate_span.add(points=labels.shape[0])
+
+            if with_positions:
+                yield input_tensor, labels, batch[-1][3]
+            else:
+                yield input_tensor, labels
 
+def batch_iterator(prepared_examples, batch_size=1, max_voxels_per_batch=None):
+    # With max_voxels_per_batch set, scenes are packed until the next one would
+    # exceed the voxel budget; batch_size (if not None) still caps the scene
+    # count. A single scene larger than the budget is emitted on its own.
+    batch = []
+    num_voxels = 0
 
-        for example in self.examples:
-            points = []
-            intensities = []
-            normals = []
-            scan_origins = []
+    for prepared_example in prepared_examples:
+        if prepared_example is None:
+            continue
 
-            example: Example = example
-            scene_name = os.path.basename(example.label.filename).split('_')[1].split('.')[0]
+        num_example_voxels = prepared_example[0].shape[0]
 
-            if os.path.exists( os.path.join(self.work_dir, example.capture_id, '{}.npy'.format(scene_name)) ):
-                print("Merged Point Cloud Already exists, skiping ")
-                continue
-            else:
-                if(not os.path.exists(os.path.join(self.work_dir, example.capture_id))):
-                    os.mkdir(os.path.join(self.work_dir, example.capture_id))
-
-                print("Merging Point Cloud for {}".format(os.path.join(self.work_dir, example.capture_id, '{}.npy'.format(scene_name)) ))
-
-                floor_plan = io.load_svg_from_file(example.floor_plan.filename)
-                #
-                view_box = [float(value) for value in floor_plan.getroot().attrib["viewBox"].split(" ")]
-                width = int(np.ceil(view_box[2]))
-                height = int(np.ceil(view_box[3]))
-
-                if width * height > 2000 * 1500:
-                    print("Skipping Florplan, to large ....{} {}".format(width,height))
-                    continue
-
-                filenames = [scan.filename for scan in example.scans]
-                transformations = example.transformations
-
-                if len(filenames) == 0:
-                    continue
-
-                for filename, transformation in zip(filenames, transformations):
-                    point_cloud = pupil_vision.read_point_cloud(filename)
-                    point_cloud.estimate_normals()
-                    point_cloud.orient_normals_towards_camera_location(camera_location=np.array([0.0, 0.0, 0.0]))
-                    point_cloud.transform(transformation)
-
-                    points.append(np.asarray(point_cloud.points))
-                    intensities.append(np.asarray(point_cloud.intensities))
-                    normals.append(np.asarray(point_cloud.normals))
-
-                    scan_origins.append(transformation[0:3, 3])
-
-                point_cloud = open3d.geometry.PointCloud()
-                point_cloud.points = open3d.utility.Vector3dVector(np.concatenate(points, axis=0))
-
-                main_component_mask = filter_by_connected_components(point_cloud, scan_origins)
-
-                coords = np.concatenate(points, axis=0)[main_component_mask, ...]
-                np_points = coords
-                np_intensities = np.concatenate(intensities, axis=0)[main_component_mask, np.newaxis]
-                np_normals = np.concatenate(normals, axis=0)[main_component_mask]
-                np_combined_ptCl = np.concatenate([np_points, np_intensities, np_normals], axis=1).astype(np.float16)
-                print("Saving Merged Point Cloud {} ".format(os.path.join(self.work_dir,example.capture_id, '{}.npy'.format(scene_name))))
-                np.save(os.path.join(self.work_dir,example.capture_id, '{}.npy'.format(scene_name)), np_combined_ptCl)
-
-        print("Done cnversion of pointclouds to Numpy format")
-
-    def iterator(self):
-        voxel_size = 0.08
-
-        for example in itertools.chain(self.examples, self.examples, self.examples, self.examples, self.examples):
-            example: Example = example
-            # print(example.label.path)
-            # if (example.label.path != "plan-view-label-generation/5c6273962ffa2b9fa59ee16006c4b5a92dae5e16/2514--3c770956-c09d-4ef2-9fac-2ddefc56d508_e9d13996-59c0-48fe-a396-e51740fcd218.exr"):
-            #     continue
-            label = exr_io.load_semantic_image(example.label.filename)
-            floor_plan = io.load_svg_from_file(example.floor_plan.filename)
-
-            canvas = np.zeros(label.shape[0:2], dtype=np.uint8)
-            colour_map = create_generic_colormap(label.shape[2]).astype(np.uint8)
-            for class_index in range(label.shape[2]):
-                channel = label[:, :, class_index]
-                channel[channel==class_index] = 255
-                # kernel = np.ones((35, 35), np.uint8)
-                # channel = cv2.dilate(np.asarray(channel, dtype='uint8'), kernel, iterations=1)
-                canvas[channel > 0] = class_index
-
-            # plt.subplot(121)
-            # plt.imshow(colour_map[canvas])
-
-            width, height, inverse_projection_matrix, projection_matrix = svg_parser.get_inverse_projection_matrix([float(value) for value in floor_plan.getroot().attrib["viewBox"].split(" ")])
-            if width * height > 2000 * 1500:
-                continue
+        if batch:
+            batch_full = batch_size is not None and len(batch) >= batch_size
+            over_budget = max_voxels_per_batch is not None and num_voxels + num_example_voxels > max_voxels_per_batch
 
-            filenames = [scan.filename for scan in example.scans]
-            transformations = example.transformations
-            scene_name = os.path.basename(example.label.filename).split('_')[1].split('.')[0]
-            # savePointClouds(filenames, transformations, scene_name, self.work_dir)
-            if len(filenames) == 0:
-                continue
-            #
-            input_tensor, ptCld_labels,  min_coords, max_coords = generate_input_sparse_tensor(filenames, transformations, voxel_size, projection_matrix, canvas,width, height, example.merged_pointloud)
-            # diff_coords = max_coords - min_coords
-            # dx = diff_coords[0] / voxel_size
-            # dy = diff_coords[1] / voxel_size
-            # minkowski_projection_matrix = np.array(
-            #     [
-            #         [1.0 / (voxel_size * dx), 0.0, -min_coords[0] / (voxel_size * dx)],
-            #         [0.0, 1.0 / (voxel_size * dy), -min_coords[1] / (voxel_size * dy)],
-            #         [0.0, 0.0, 1.0]
-            #     ]
-            # )
-            # u, v = np.meshgrid(np.linspace(0.0, 1.0, width), np.linspace(0.0, 1.0, height))
-            # uvw_label = np.stack([u, v, np.ones_like(u)], axis=2)
-            # xyz = np.matmul(uvw_label, inverse_projection_matrix.transpose())
-            # uv_minkowski = np.expand_dims(2.0 * np.matmul(xyz, minkowski_projection_matrix.transpose())[:, :, 0:2] - 1.0, axis=0)
-            # uv_minkowski = np.stack([uv_minkowski[..., 1], uv_minkowski[..., 0]] , axis=3)
-            yield input_tensor, ptCld_labels
+            if batch_full or over_budget:
+                yield batch
+                batch = []
+                num_voxels = 0
+
+        batch.append(prepared_example)
+        num_voxels += num_example_voxels
+
+    if batch:
+        yield batch
+
+def prepare_example(example, voxel_size, cache=None):
+    if cache is None:
+        return _prepare_example(example, voxel_size)
+
+    key = cache.key(example, voxel_size, [point_cloud_store.manifest_filename(example.merged_pointloud)])
+    with profiler.span("example_cache_load") as cache_span:
+        cached = cache.load(key)
+        if cached is not None and cached[1] is not None:
+            cache_span.add(points=cached[1][0].shape[0], num_bytes=sum(array.nbytes for array in cached[1]))
+
+    if cached is not None:
+        _, arrays = cached
+        return arrays
+
+    prepared_example = _prepare_example(example, voxel_size)
+    cache.store(key, prepared_example)
+
+    return cache.load(key)[1]
+
+def _prepare_example(example, voxel_size):
+    example: Example = example
+    # print(example.label.path)
+    # if (example.label.path != "plan-view-label-generation/5c6273962ffa2b9fa59ee16006c4b5a92dae5e16/2514--3c770956-c09d-4ef2-9fac-2ddefc56d508_e9d13996-59c0-48fe-a396-e51740fcd218.exr"):
+    #     continue
+    filenames = [scan.filename for scan in example.scans]
+    transformations = example.transformations
+    if len(filenames) == 0:
+        return None
+
+    with profiler.span("exr_decode") as exr_span:
+        canvas = exr_io.load_semantic_canvas(example.label.filename)
+        exr_span.add(points=canvas.size, num_bytes=canvas.nbytes)
+
+    with profiler.span("floor_plan"):
+        raster = floor_plan_raster.load_floor_plan_raster(example.floor_plan.filename, masks=())
+
+    width, height, projection_matrix = raster.width, raster.height, raster.projection_matrix
+    if width * height > 2000 * 1500:
+        return None
+
+    # Only charged the time not covered by the npy_load, projection,
+    # distance_features and quantization spans inside load_files.
+    with profiler.span("prepare_example") as prepare_span:
+        quantized_coords, features, ptCld_labels, min_coords, max_coords = load_files(filenames, transformations, voxel_size, projection_matrix, canvas, width, height, example.merged_pointloud)
+        prepare_span.add(points=quantized_coords.shape[0])
+
+    return quantized_coords, features, ptCld_labels
 
 def safe_div(x, y):
     return x / np.where(y > 0, y, np.ones_like(y))
@@ -315,48 +314,24 @@ def filter_by_connected_components(point_cloud, scan_origins, radius=0.1, max_nn
     # print("Filtering point cloud of shape {} using connected components".format(points.shape))
     # print("Using parameters (radius = {}, max_nn = {}, max_num_nearby_points = {}, always_include_radius = {})".format(radius, max_nn, max_num_nearby_points, always_include_radius))
 
-    # Convert origins to a 1 x 3 x D array
-    origins = np.expand_dims(np.transpose(np.array(scan_origins), axes=[1, 0]), axis=0)
-
-    # Convert points to a N x 3 x 1 array
-    tiled_points = np.expand_dims(points, axis=2)
-
-    max_batch_size = 100000
-    num_batches = int(np.ceil(float(num_points) / float(max_batch_size)))
-    min_distances = np.zeros((num_points,), dtype = np.float32)
-    for batch_index in range(num_batches):
-        batch_start = batch_index * max_batch_size
-        batch_end = batch_start + min(max_batch_size, num_points - batch_start)
-        distances = np.linalg.norm(origins - tiled_points[batch_start:batch_end, ...], axis=1, ord=2)
-        min_distances[batch_start:batch_end] = np.min(distances, axis=1)
-
-    sorted_point_indices = np.argsort(min_distances)
+    min_distances = min_distances_from_scan_locations(points, scan_origins)
 
     always_included_indices = np.where(min_distances < always_include_radius)
 
     # Find neighbours of points
     filtered_triplets = pupil_vision.find_triplets(kdtree, point_cloud, radius, max_nn) # [T, 3]
 
-    # Find closest points to origin
-    nearby_point_triplet_list = []
-    num_nearby_points = min(max_num_nearby_points, sorted_point_indices.shape[0])
-    for index in range(num_nearby_points):
-        for pair_index in range(index + 1, num_nearby_points):
-            if sorted_point_indices[index] > sorted_point_indices[pair_index]:
-                nearby_point_triplet_list.append([sorted_point_indices[index], sorted_point_indices[pair_index], 1])
-            else:
-                nearby_point_triplet_list.append([sorted_point_indices[pair_index], sorted_point_indices[index], 1])
-
-    nearby_point_triplets = np.array(nearby_point_triplet_list, dtype = np.int32)
+    # Connect the points closest to the scan origins
+    nearby_rows, nearby_cols = nearby_point_edges(min_distances, max_num_nearby_points)
 
-    # Concatenate triplets from NN search and closest points search
-    all_triplets = np.concatenate([filtered_triplets, nearby_point_triplets], axis=0)
+    rows = np.concatenate([filtered_triplets[:, 0], nearby_rows]).astype(np.int32, copy=False)
+    cols = np.concatenate([filtered_triplets[:, 1], nearby_cols]).astype(np.int32, copy=False)
     del filtered_triplets
-    del nearby_point_triplets
-    del nearby_point_triplet_list
 
-    # print("Constructing sparse matrix with (shape = {}, nnz = {})".format((num_points, num_points), all_triplets.shape[0]))
-    graph = scipy.sparse.coo_matrix((all_triplets[:, 2], (all_triplets[:, 0], all_triplets[:, 1])), shape=(num_points, num_points))
+    # print("Constructing sparse matrix with (shape = {}, nnz = {})".format((num_points, num_points), rows.shape[0]))
+    graph = build_adjacency_graph(rows, cols, num_points)
+    del rows
+    del cols
 
     # print("Finding connected components from sparse matrix")
     num_components, components = scipy.sparse.csgraph.connected_components(graph, directed = False)
@@ -367,26 +342,92 @@ def filter_by_connected_components(point_cloud, scan_origins, radius=0.1, max_nn
 
     return main_component_mask
 
-def min_distances_from_scan_locations(points, scan_origins):
+def nearby_point_edges(min_distances, max_num_nearby_points):
+    num_nearby_points = min(max_num_nearby_points, min_distances.shape[0])
+    if num_nearby_points < 2:
+        empty = np.zeros((0,), dtype=np.int32)
+        return empty, empty
+
+    # Only the membership of the closest points is needed, not their order.
+    nearby_points = np.argpartition(min_distances, num_nearby_points - 1)[:num_nearby_points].astype(np.int32)
+
+    # The closest points used to be joined pairwise (a clique of n (n - 1) / 2
+    # edges). Connected components only depend on reachability, so a star
+    # through the first point yields the same components with n - 1 edges.
+    hub = np.full((num_nearby_points - 1,), nearby_points[0], dtype=np.int32)
+    spokes = nearby_points[1:]
+
+    return np.maximum(hub, spokes), np.minimum(hub, spokes)
+
+def build_adjacency_graph(rows, cols, num_points):
+    # Build the CSR arrays directly instead of going through a COO matrix,
+    # whose conversion sorts and sums duplicate entries. Duplicates are harmless
+    # for connected components, and the float64 data matches what csgraph
+    # validation expects so the matrix is not copied again.
+    if rows.shape[0] > 1 and np.any(rows[1:] < rows[:-1]):
+        order = np.argsort(rows, kind="stable")
+        rows = rows[order]
+        cols = cols[order]
+
+    indptr = np.zeros((num_points + 1,), dtype=np.int32)
+    np.cumsum(np.bincount(rows, minlength=num_points), out=indptr[1:])
+    data = np.ones(cols.shape, dtype=np.float64)
+
+    return scipy.sparse.csr_matrix((data, cols, indptr), shape=(num_points, num_points))
+
+def min_distances_from_scan_locations(points, scan_origins, max_direct_origins=32, max_batch_size=1000000):
     num_points, _ = points.shape
+    origins = np.asarray(scan_origins, dtype=np.float32).reshape(-1, 3)
+
+    if origins.shape[0] > max_direct_origins:
+        # Many scans: a nearest-neighbour query over the origins beats testing them all.
+        distances, _ = scipy.spatial.cKDTree(origins).query(points, k=1)
+        return distances.astype(np.float32)
+
+    # Few scans: keep a running minimum over the origins in float32, working
+    # through the points in batches with scratch buffers reused across batches
+    # rather than building an N x 3 x S difference array.
+    min_distances = np.empty((num_points,), dtype=np.float32)
+    squared_distances = np.empty((min(max_batch_size, num_points),), dtype=np.float32)
+    batch_min = np.empty_like(squared_distances)
+    difference = np.empty_like(squared_distances)
+
+    for batch_start in range(0, num_points, max_batch_size):
+        batch_end = min(batch_start + max_batch_size, num_points)
+        batch_points = points[batch_start:batch_end]
+        batch_length = batch_end - batch_start
+
+        batch_min[:batch_length] = np.inf
+        for origin in origins:
+            squared_distances[:batch_length] = 0.0
 
-    # Convert origins to a 1 x 3 x D array
-    origins = np.expand_dims(np.transpose(np.array(scan_origins), axes=[1, 0]), axis=0)
+            for axis in range(3):
+                np.subtract(batch_points[:, axis], origin[axis], out=difference[:batch_length], dtype=np.float32)
+                np.multiply(difference[:batch_length], difference[:batch_length], out=difference[:batch_length])
+                squared_distances[:batch_length] += difference[:batch_length]
 
-    # Convert points to a N x 3 x 1 array
-    tiled_points = np.expand_dims(points, axis=2)
+            np.minimum(batch_min[:batch_length], squared_distances[:batch_length], out=batch_min[:batch_length])
 
-    max_batch_size = 100000
-    num_batches = int(np.ceil(float(num_points) / float(max_batch_size)))
-    min_distances = np.zeros((num_points,), dtype = np.float32)
-    for batch_index in range(num_batches):
-        batch_start = batch_index * max_batch_size
-        batch_end = batch_start + min(max_batch_size, num_points - batch_start)
-        distances = np.linalg.norm(origins - tiled_points[batch_start:batch_end, ...], axis=1, ord=2)
-        min_distances[batch_start:batch_end] = np.min(distances, axis=1)
+        np.sqrt(batch_min[:batch_length], out=min_distances[batch_start:batch_end])
 
     return min_distances
 
+def load_merged_point_cloud(merged_pointCloud, columns=(point_cloud_store.XYZ, point_cloud_store.INTENSITY, point_cloud_store.NORMALS, point_cloud_store.SCAN_DISTANCES)):
+    if point_cloud_store.point_cloud_exists(merged_pointCloud):
+        return point_cloud_store.load_point_cloud(merged_pointCloud, columns)
+
+    # Legacy N x 7 float16 .npy (xyz, intensity, normals), without distances.
+    # Columns are views into the memory map, so only the rows that are indexed
+    # later get read.
+    np_point_cloud = np.load(merged_pointCloud, mmap_mode="r")
+    legacy_columns = {
+        point_cloud_store.XYZ: np_point_cloud[:, 0:3],
+        point_cloud_store.INTENSITY: np_point_cloud[:, 3],
+        point_cloud_store.NORMALS: np_point_cloud[:, 4:7]
+    }
+
+    return dict((name, legacy_columns[name]) for name in columns if name in legacy_columns)
+
 def make_homogeneous(points):
     num_points, _ = points.shape
     return np.concatenate([points, np.ones(shape = [num_points, 1], dtype = points.dtype)], axis = 1)
@@ -423,10 +464,10 @@ def load_files(filenames, transformations, voxel_size, projection_matrix, canvas
     #main_component_mask = filter_by_connected_components(point_cloud, scan_origins)
 
     # print(f"Main component has {np.count_nonzero(main_component_mask)} points")
-    np_point_cloud = np.load(merged_pointCloud)
-    coords = np_point_cloud[:,0:3]
-
-    print(np.shape(coords), np.shape(intensities), np.shape(normals), np.shape(scan_origins))
+    with profiler.span("npy_load") as load_span:
+        columns = load_merged_point_cloud(merged_pointCloud)
+        coords = np.asarray(columns[point_cloud_store.XYZ])
+        load_span.add(points=coords.shape[0], num_bytes=coords.nbytes)
 
 
     # coords = np.concatenate(points, axis=0)[main_component_mask, ...]
@@ -435,20 +476,21 @@ def load_files(filenames, transformations, voxel_size, projection_matrix, canvas
     # np_point_cloud = np.asarray(point_cloud_filered.points)
 
 
-    homogeneous_point_cloud = make_homogeneous(coords)
-    projected_point_cloud = np.matmul(homogeneous_point_cloud, projection_matrix.transpose())
-    uv = projected_point_cloud[:, 0:2]
-    uv = np.asarray(np.matmul(uv, np.asarray(((width, 0), (0, height)))), dtype='uint32')
+    with profiler.span("projection", points=coords.shape[0]):
+        homogeneous_point_cloud = make_homogeneous(coords)
+        projected_point_cloud = np.matmul(homogeneous_point_cloud, projection_matrix.transpose())
+        uv = projected_point_cloud[:, 0:2]
+        uv = np.asarray(np.matmul(uv, np.asarray(((width, 0), (0, height)))), dtype='uint32')
 
-    valid_uv_indices = np.intersect1d(np.where(uv[:,0]<width) , np.where( uv[:,1]<height))
-    uv = uv[valid_uv_indices]
-    coords = coords[valid_uv_indices]
-    colors = np.zeros(np.shape(coords))
+        valid_uv_indices = np.intersect1d(np.where(uv[:,0]<width) , np.where( uv[:,1]<height))
+        uv = uv[valid_uv_indices]
+        coords = coords[valid_uv_indices]
 
+        labels_flat = np.reshape(canvas, [width*height, 1])
+        i = uv[:,0]+uv[:,1]*width
+        ptCld_labels = np.take(labels_flat,i)
 
-    labels_flat = np.reshape(canvas, [width*height, 1])
-    i = uv[:,0]+uv[:,1]*width
-    ptCld_labels = np.take(labels_flat,i)
+    colors = np.zeros(np.shape(coords))
 
     bg_ind = np.where(ptCld_labels == 0)
     bg = uv[bg_ind[0]]
@@ -487,23 +529,58 @@ def load_files(filenames, transformations, voxel_size, projection_matrix, canvas
 
     #intensities = np.expand_dims(2.0 * np.concatenate(intensities, axis=0) - 1.0, axis=1)[main_component_mask, ...][valid_uv_indices]
     #normals = np.concatenate(normals, axis=0)[main_component_mask, ...][valid_uv_indices]
-    intensities = np.expand_dims(2.0 * np_point_cloud[:, 3] - 1, axis=1)[valid_uv_indices]
-    normals = np_point_cloud[:, 4:7][valid_uv_indices]
-    min_distances = np.expand_dims(min_distances_from_scan_locations(coords, scan_origins), axis=1)
+    with profiler.span("distance_features", points=coords.shape[0]):
+        intensities = np.expand_dims(2.0 * columns[point_cloud_store.INTENSITY][valid_uv_indices] - 1, axis=1)
+        normals = columns[point_cloud_store.NORMALS][valid_uv_indices]
+        # Prefer the distances precomputed by the merge stage over recomputing them every epoch
+        if point_cloud_store.SCAN_DISTANCES in columns:
+            min_distances = np.expand_dims(columns[point_cloud_store.SCAN_DISTANCES][valid_uv_indices], axis=1)
+        else:
+            min_distances = np.expand_dims(min_distances_from_scan_locations(coords, scan_origins), axis=1)
 
-    features = np.concatenate([intensities, normals, min_distances], axis=1)
+        features = np.concatenate([intensities, normals, min_distances], axis=1)
 
-    quantized_coords = np.floor(coords / voxel_size)
-    indices = ME.utils.sparse_quantize(quantized_coords)
+    with profiler.span("quantization", points=coords.shape[0]):
+        quantized_coords = np.floor(coords / voxel_size)
+        indices = ME.utils.sparse_quantize(quantized_coords)
 
     return quantized_coords[indices], features[indices], ptCld_labels[indices], np.min(coords, axis=0), np.max(coords, axis=0)
 
+def numpy_dtype(torch_dtype):
+    return torch.empty((0,), dtype=torch_dtype).numpy().dtype if torch_dtype is not None else None
+
+def make_input_sparse_tensor(prepared_examples, feature_dtype=None):
+    coordinates_, features_, labels_ = list(zip(*prepared_examples))
+
+    if feature_dtype is None:
+        coordinates, features, labels = ME.utils.sparse_collate(coordinates_, features_, labels_)
+    else:
+        # Features can be kept in half precision until they reach the device,
+        # see input_tensor_to_device. sparse_collate upcasts every scene's
+        # features to float32, so it only batches the coordinates and labels
+        # (with zero-width placeholder features) and each scene is cast to
+        # feature_dtype before concatenation. Features already stored in that
+        # dtype (ExampleCache with feature_dtype) are not copied by the cast.
+        placeholders = [np.empty((len(scene_coordinates), 0), dtype=np.float32) for scene_coordinates in coordinates_]
+        coordinates, _, labels = ME.utils.sparse_collate(coordinates_, placeholders, labels_)
+        features = torch.cat([torch.as_tensor(scene_features).to(feature_dtype) for scene_features in features_], 0)
+
+    # Normalize features and create a sparse tensor
+    return ME.SparseTensor(features, coords=coordinates), labels.long()
+
+def input_tensor_to_device(input_tensor, device):
+    # The Minkowski kernels are only built for float32 and float64, so half
+    # precision features are upcast after the copy, on the device. The
+    # coordinates stay with the coordinate manager and are not copied.
+    input_tensor = input_tensor.to(device)
+    if input_tensor.F.dtype == torch.float16:
+        input_tensor = ME.SparseTensor(input_tensor.F.float(), coords_key=input_tensor.coords_key, coords_manager=input_tensor.coords_man)
+
+    return input_tensor
+
 def generate_input_sparse_tensor(filenames, transformations, voxel_size, projection_matrix, canvas,width, height, merged_pointCloud):
     # Create a batch, this process is done in a data loader during training in parallel.
     quantized_coords, corresponding_features, ptCld_labels,  min_coords, max_coords = load_files(filenames, transformations, voxel_size, projection_matrix, canvas,width, height, merged_pointCloud)
-    batch = [(quantized_coords, corresponding_features)]
-    coordinates_, features_ = list(zip(*batch))
-    coordinates, features = ME.utils.sparse_collate(coordinates_, features_)
+    input_tensor, labels = make_input_sparse_tensor([(quantized_coords, corresponding_features, np.array(ptCld_labels))])
 
-    # Normalize features and create a sparse tensor
-    return ME.SparseTensor(features, coords=coordinates), torch.from_numpy(np.array(ptCld_labels)).long(),  min_coords, max_coords
\ No newline at end of file
+    return input_tensor, labels, min_coords, max_coords
\ No newline at end of file
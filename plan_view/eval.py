@@ -2,8 +2,10 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import argparse
 import numpy as np
 import open3d
+import os
 import pupil_vision
 
 import MinkowskiEngine as ME
@@ -24,7 +26,10 @@ from MinkowskiEngine.modules.resnet_block import BasicBlock, Bottleneck
 
 from torch.optim import Adam, SGD
 
+from plan_view import back_projection
 from plan_view.dataloader import DataLoader
+from plan_view.inference import InferenceEngine
+from plan_view.training_runner import load_model_state
 
 from scipy.special import expit
 
@@ -250,84 +255,44 @@ PUPIL_COLOR_MAP = {
 
 }
 
-if __name__ == '__main__':
-    work_dir = "/media/apurvnigam/Storage/tmp/MinkowskiEngine"
-    dataloader = DataLoader("9ba730a34e594841a84aeac52eed12d4", work_dir, num_shards=2)
-    criterion = nn.CrossEntropyLoss()
-    net = MinkUNet34C(in_channels=5, out_channels=4, D=3)
-    #
-    model_dict = torch.load("network_iter2100.pth")
-    net.load_state_dict(model_dict)
-
-    # a data loader must return a tuple of coords, features, and labels.
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-
-    net = net.to(device)
-    optimizer = SGD(net.parameters(), lr=1e-2)
-
-
-
-
-    for index, (input_tensor, label) in enumerate(dataloader.iterator()):
-        torch.cuda.empty_cache()
-        optimizer.zero_grad()
-
-        try:
-
-            input = input_tensor.to(device)
-            # label = label.to(device)
-
-            # Forward
-            output = net(input)
+# Lookup table from predicted class to color, indexed with the whole prediction array
+PUPIL_COLORS = np.array([PUPIL_COLOR_MAP[VALID_CLASS_IDS[l]] for l in range(len(VALID_CLASS_IDS))])
 
+def show_predictions(coords, logits, voxel_size):
+    pred = logits.argmax(1).numpy()
+    colors = PUPIL_COLORS[pred]
 
-            if index % 1 == 0:
+    pred_pcd = open3d.geometry.PointCloud()
+    pred_pcd.points = open3d.utility.Vector3dVector(coords * voxel_size)
+    pred_pcd.colors = open3d.utility.Vector3dVector(colors / 255)
+    open3d.visualization.draw_geometries([pred_pcd])
 
-                _, pred = output.F.max(1)
-                pred = pred.cpu().numpy()
-                colors = np.array([PUPIL_COLOR_MAP[VALID_CLASS_IDS[l]] for l in pred])
-                pred_pcd = open3d.geometry.PointCloud()
-                coordinates = output.C.numpy()[:, :3]  # last column is the batch index
-                pred_pcd.points = open3d.utility.Vector3dVector(coordinates * 0.02)
-                pred_pcd.colors = open3d.utility.Vector3dVector(colors / 255)
-                open3d.visualization.draw_geometries([pred_pcd])
-                # vis = open3d.visualization.Visualizer()
-                # vis.create_window()
-                #
-                # vis.add_geometry(pred_pcd)
-                # vis.update_geometry()
-                # vis.poll_events()
-                # vis.update_renderer()
-                #
-                # time.sleep(2)
-                # vis.destroy_window()
-            # if index%50 ==0:
-            #     torch.save(net.state_dict(), 'network_iter{}.pth'.format(index))
-
-
-                # pred_pcd.points = open3d.Vector3dVector([])
-                # pred_pcd.colors = open3d.Vector3dVector([])
-                # vis.update_geometry()
-                # vis.poll_events()
-                # vis.update_renderer()
-
-
-
-
-            # Loss
-            # loss = criterion(output.F, label)
-            # print('Iteration: ', index, ', Loss: ', loss.item())
-
-            # Gradient
-            # loss.backward()
-            # optimizer.step()
-
-        except:
-            # import traceback
-            # traceback.print_exc(e)
-            pass
-
-        # Saving and loading a network
-    # torch.save(net.state_dict(), 'test.pth')
-    # net.load_state_dict(torch.load('test.pth'))
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("execution_id")
+    parser.add_argument("work_dir")
+    parser.add_argument("checkpoint", help="Runner checkpoint or bare model state dict")
+    parser.add_argument("--output_dir", default=None)
+    parser.add_argument("--num_shards", type=int, default=2)
+    parser.add_argument("--voxel_size", type=float, default=0.08)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--max_voxels_per_batch", type=int, default=400000)
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--cache_dir", default=None)
+    parser.add_argument("--back_projection", default=None, choices=[back_projection.VOTES, back_projection.LOGITS, back_projection.PROBABILITIES], help="Also write a plan-view raster of the predictions per scene")
+    parser.add_argument("--visualize", action="store_true", help="Show every scene in an Open3D window instead of writing predictions")
+    args = parser.parse_args()
+
+    dataloader = DataLoader(args.execution_id, args.work_dir, num_shards=args.num_shards)
+    net = MinkUNet34C(in_channels=5, out_channels=4, D=3)
+    net.load_state_dict(load_model_state(args.checkpoint))
 
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    engine = InferenceEngine(net, device, args.voxel_size, args.batch_size, args.max_voxels_per_batch, args.num_workers, cache_dir=args.cache_dir)
+
+    if args.visualize:
+        for example, coords, logits in engine.predict(dataloader.examples):
+            show_predictions(coords, logits, args.voxel_size)
+    else:
+        output_dir = args.output_dir if args.output_dir is not None else os.path.join(args.work_dir, "predictions")
+        engine.run(dataloader.examples, output_dir, back_projection_mode=args.back_projection)
@@ -0,0 +1,109 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from pupil.atomic import AtomicDirectory
+
+# Bump whenever prepare_example changes what it produces for the same inputs.
+CACHE_VERSION = 1
+
+_ARRAY_DTYPES = {
+    "coords": np.int32,
+    "features": np.float32,
+    "labels": np.uint8
+}
+
+def _file_signature(filename):
+    if filename is None or not os.path.exists(filename):
+        return [filename, None, None]
+
+    stat = os.stat(filename)
+    return [filename, stat.st_size, stat.st_mtime_ns]
+
+class ExampleCache:
+    def __init__(self, cache_dir, feature_dtype=None):
+        # feature_dtype (a numpy dtype) overrides the stored feature precision,
+        # e.g. float16 for half precision training batches.
+        self.cache_dir = cache_dir
+        self.feature_dtype = np.dtype(feature_dtype) if feature_dtype is not None else None
+
+    def array_dtypes(self):
+        array_dtypes = dict(_ARRAY_DTYPES)
+        if self.feature_dtype is not None:
+            array_dtypes["features"] = self.feature_dtype
+
+        return array_dtypes
+
+    def key(self, example, voxel_size, input_files=()):
+        # The projection parameters are derived from the floor plan viewBox, so
+        # the floor plan signature stands in for them; any rewrite of the label,
+        # floor plan or merged point cloud changes the key and invalidates the entry.
+        payload = {
+            "version": CACHE_VERSION,
+            "label": _file_signature(example.label.filename),
+            "floor_plan": _file_signature(example.floor_plan.filename),
+            "merged_point_cloud": _file_signature(example.merged_pointloud),
+            "inputs": [_file_signature(filename) for filename in input_files],
+            "transformations": [np.asarray(transformation).tolist() for transformation in example.transformations],
+            "voxel_size": float(voxel_size)
+        }
+
+        # Only set when overridden, so float32 entries keep their keys.
+        if self.feature_dtype is not None:
+            payload["feature_dtype"] = self.feature_dtype.str
+
+        return hashlib.sha1(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def contains(self, key):
+        return os.path.exists(os.path.join(self.entry_dir(key), "meta.json"))
+
+    def load(self, key):
+        entry_dir = self.entry_dir(key)
+        meta_filename = os.path.join(entry_dir, "meta.json")
+
+        if not os.path.exists(meta_filename):
+            return None
+
+        with open(meta_filename, "r") as meta_file:
+            meta = json.load(meta_file)
+
+        if meta["skipped"]:
+            return meta, None
+
+        # Copy-on-write maps keep the pages shared with the page cache while
+        # still handing torch.from_numpy a writable array.
+        arrays = tuple(np.load(os.path.join(entry_dir, "{}.npy".format(name)), mmap_mode="c") for name in _ARRAY_DTYPES)
+
+        return meta, arrays
+
+    def store(self, key, arrays=None):
+        entry_dir = self.entry_dir(key)
+        if os.path.exists(entry_dir):
+            return
+
+        # Entries are assembled in a private directory and renamed into place, so
+        # concurrent workers and interrupted runs never expose a partial entry.
+        # If another worker commits the same entry first, its copy is kept.
+        with AtomicDirectory(entry_dir) as directory:
+            meta = {
+                "version": CACHE_VERSION,
+                "skipped": arrays is None
+            }
+
+            if arrays is not None:
+                for (name, dtype), array in zip(self.array_dtypes().items(), arrays):
+                    np.save(os.path.join(directory.path, "{}.npy".format(name)), np.ascontiguousarray(array, dtype=dtype))
+
+                meta["num_points"] = int(arrays[0].shape[0])
+
+            with open(os.path.join(directory.path, "meta.json"), "w") as meta_file:
+                json.dump(meta, meta_file)
@@ -0,0 +1,118 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from plan_view.dataloader import DataLoader, prepare_example, scene_name
+from plan_view.example_cache import ExampleCache
+from plan_view.prefetch import prefetch
+from pupil.atomic import atomic_file
+
+# Per-point training samples (the output of prepare_example) exported as Parquet,
+# one file per scene, hive-partitioned by capture:
+#
+#   <output_dir>/capture_id=<capture_id>/<scene>.parquet
+#
+# Row groups are bounded by row_group_size and carry min/max statistics, so
+# readers such as pyarrow.dataset can prune on label, coordinates or scene.
+#
+# pyarrow is only needed by this stage and imported on first use.
+
+cache = {}
+
+def get_schema():
+    import pyarrow as pa
+
+    if "schema" not in cache:
+        cache["schema"] = pa.schema([
+            ("scene", pa.dictionary(pa.int32(), pa.string())),
+            ("x", pa.int32()),
+            ("y", pa.int32()),
+            ("z", pa.int32()),
+            ("intensity", pa.float32()),
+            ("normal_x", pa.float32()),
+            ("normal_y", pa.float32()),
+            ("normal_z", pa.float32()),
+            ("scan_distance", pa.float32()),
+            ("label", pa.uint8())
+        ])
+
+    return cache["schema"]
+
+def sample_table(scene, quantized_coords, features, labels):
+    import pyarrow as pa
+
+    num_points = quantized_coords.shape[0]
+    quantized_coords = np.asarray(quantized_coords, dtype=np.int32)
+    features = np.asarray(features, dtype=np.float32)
+
+    columns = [
+        pa.DictionaryArray.from_arrays(np.zeros((num_points,), dtype=np.int32), [scene]),
+        quantized_coords[:, 0],
+        quantized_coords[:, 1],
+        quantized_coords[:, 2],
+        features[:, 0],
+        features[:, 1],
+        features[:, 2],
+        features[:, 3],
+        features[:, 4],
+        np.asarray(labels, dtype=np.uint8)
+    ]
+
+    return pa.Table.from_arrays([pa.array(column) if isinstance(column, np.ndarray) else column for column in columns], schema=get_schema())
+
+def write_scene(filename, scene, quantized_coords, features, labels, row_group_size):
+    import pyarrow.parquet as pq
+
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+    with atomic_file(filename) as temp_filename:
+        with pq.ParquetWriter(temp_filename, get_schema(), compression="zstd", write_statistics=True) as writer:
+            # One row group at a time keeps the Arrow copy of a scene bounded.
+            for start in range(0, quantized_coords.shape[0], row_group_size):
+                end = start + row_group_size
+                writer.write_table(sample_table(scene, quantized_coords[start:end], features[start:end], labels[start:end]), row_group_size=row_group_size)
+
+def export_samples(examples, output_dir, voxel_size=0.08, row_group_size=1000000, num_workers=0, cache_dir=None):
+    cache = ExampleCache(cache_dir) if cache_dir is not None else None
+    prepared_examples = prefetch(prepare_example, ((example, voxel_size, cache) for example in examples), num_workers)
+
+    num_rows = 0
+    num_files = 0
+    start_time = time.time()
+
+    for example, prepared_example in zip(examples, prepared_examples):
+        if prepared_example is None:
+            continue
+
+        quantized_coords, features, labels = prepared_example
+        scene = scene_name(example)
+        filename = os.path.join(output_dir, "capture_id={}".format(example.capture_id), "{}.parquet".format(scene))
+
+        write_scene(filename, scene, quantized_coords, features, labels, row_group_size)
+
+        num_rows += quantized_coords.shape[0]
+        num_files += 1
+        print("Exported {} samples to {} ({:.0f} rows/s overall)".format(quantized_coords.shape[0], filename, num_rows / max(time.time() - start_time, 1e-6)))
+
+    print("Exported {} rows in {} files to {}".format(num_rows, num_files, output_dir))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("execution_id")
+    parser.add_argument("work_dir")
+    parser.add_argument("output_dir")
+    parser.add_argument("--num_shards", type=int, default=1)
+    parser.add_argument("--voxel_size", type=float, default=0.08)
+    parser.add_argument("--row_group_size", type=int, default=1000000)
+    parser.add_argument("--num_workers", type=int, default=0)
+    parser.add_argument("--cache_dir", default=None)
+    args = parser.parse_args()
+
+    dataloader = DataLoader(args.execution_id, args.work_dir, num_shards=args.num_shards)
+    export_samples(dataloader.examples, args.output_dir, args.voxel_size, args.row_group_size, args.num_workers, args.cache_dir)
@@ -16,7 +16,7 @@ def convert_dtype(imath_pixel_type):
     elif imath_pixel_type == imath_f16:
         return np.float16
     elif imath_pixel_type == imath_f32:
-        return None
+        return np.float32
 
 def get_shape(input_file):
     exr_image = OpenEXR.InputFile(input_file)
@@ -50,31 +50,110 @@ def write_semantic_image(output_file, tensor, output_dtype=Imath.PixelType(Imath
     exr_file.writePixels(data)
     exr_file.close()
 
-def load_semantic_image(input_file, output_dtype=None):
+def load_semantic_image(input_file, output_dtype=None, channels=None, window=None, channels_first=False, out=None):
+    # channels selects channel indices (all by default) and window an
+    # (x_min, y_min, x_max, y_max) pixel window, max exclusive, relative to the
+    # data window. Only the scanlines inside the window are decoded and every
+    # channel is written straight into the output buffer, which can be passed
+    # in as out (H x W x C, or C x H x W with channels_first).
     exr_image = OpenEXR.InputFile(input_file)
     header = exr_image.header()
+
+    channel_infos = _select_channel_infos(header, channels)
+    _, types = zip(*channel_infos)
+
+    x_min, y_min, x_max, y_max = _resolve_window(header, window)
+    shape = (len(channel_infos), y_max - y_min, x_max - x_min) if channels_first else (y_max - y_min, x_max - x_min, len(channel_infos))
+
+    if out is None:
+        if output_dtype is None:
+            output_dtype = convert_dtype(types[0])
+
+        out = np.empty(shape, dtype=output_dtype)
+    elif out.shape != shape:
+        raise ValueError("Output buffer has shape {}, expected {}".format(out.shape, shape))
+
+    for index, (channel_string, channel_type) in enumerate(channel_infos):
+        channel = _read_channel(exr_image, header, channel_string, channel_type, (x_min, y_min, x_max, y_max))
+
+        if channels_first:
+            out[index, :, :] = channel
+        else:
+            out[:, :, index] = channel
+
+    return out
+
+def _resolve_window(header, window):
     data_window = header["dataWindow"]
     width, height = (data_window.max.x - data_window.min.x + 1, data_window.max.y - data_window.min.y + 1)
 
+    if window is None:
+        return 0, 0, width, height
+
+    x_min, y_min, x_max, y_max = window
+    x_min, y_min = max(x_min, 0), max(y_min, 0)
+    x_max, y_max = min(x_max, width), min(y_max, height)
+
+    if x_min >= x_max or y_min >= y_max:
+        raise ValueError("Window {} does not intersect the {}x{} data window".format(window, width, height))
+
+    return x_min, y_min, x_max, y_max
+
+def _read_channel(exr_image, header, channel_string, channel_type, window):
+    # Decodes the scanlines of the window only (OpenEXR takes an inclusive
+    # scanline range in data window coordinates) and returns a view of the
+    # decoded buffer, cropped to the window columns.
+    data_window = header["dataWindow"]
+    width = data_window.max.x - data_window.min.x + 1
+    x_min, y_min, x_max, y_max = window
+
+    buffer = exr_image.channel(channel_string, channel_type, data_window.min.y + y_min, data_window.min.y + y_max - 1)
+    channel = np.frombuffer(buffer, dtype = convert_dtype(channel_type)).reshape(y_max - y_min, width)
+
+    return channel[:, x_min:x_max]
+
+def _select_channel_infos(header, channels):
+    channel_infos = _sorted_channel_infos(header)
+
+    if channels is None:
+        return channel_infos
+
+    channel_infos = dict(channel_infos)
+    return [(str(channel), channel_infos[str(channel)]) for channel in channels]
+
+def _sorted_channel_infos(header):
     channel_infos = list(header["channels"].items())
     channel_infos = list(map(lambda x: (int(x[0]), x[1].type), channel_infos))
     channel_infos = sorted(channel_infos, key = lambda x: x[0])
-    channel_infos = list(map(lambda x: (str(x[0]), x[1]), channel_infos))
-    channel_strings, types = zip(*channel_infos)
+    return list(map(lambda x: (str(x[0]), x[1]), channel_infos))
+
+# Label canvases, example caches, exported samples and predictions all store
+# classes as uint8
+MAX_CANVAS_CLASSES = 256
 
-    if output_dtype is None:
-        output_dtype = convert_dtype(types[0])
+def load_semantic_canvas(input_file, window=None):
+    # Each pixel takes the highest class index whose channel is positive, or 0
+    # (background) if none is, the priority order of a per-class loop where
+    # later classes overwrite earlier ones. Only the (classes - 1, H, W) masks
+    # of the foreground channels are stacked, one byte per pixel and class.
+    exr_image = OpenEXR.InputFile(input_file)
+    header = exr_image.header()
 
-    arrays = exr_image.channels(channel_strings)
-    np_arrays = []
+    channel_infos = _sorted_channel_infos(header)
+    num_classes = len(channel_infos)
+    if num_classes > MAX_CANVAS_CLASSES:
+        raise ValueError("{} has {} classes, label canvases hold at most {}".format(input_file, num_classes, MAX_CANVAS_CLASSES))
 
-    for index in range(len(arrays)):
-        dtype = convert_dtype(types[index])
-        np_array = np.frombuffer(arrays[index], dtype = dtype).reshape(height, width)
+    x_min, y_min, x_max, y_max = _resolve_window(header, window)
+    if num_classes < 2:
+        return np.zeros((y_max - y_min, x_max - x_min), dtype=np.uint8)
 
-        if output_dtype != np_array.dtype:
-            np_array = np.cast[output_dtype](np_array)
+    # Highest class first, so argmax finds the winning class
+    active = np.empty((num_classes - 1, y_max - y_min, x_max - x_min), dtype=bool)
+    for class_index, (channel_string, channel_type) in enumerate(channel_infos[:0:-1]):
+        channel = _read_channel(exr_image, header, channel_string, channel_type, (x_min, y_min, x_max, y_max))
+        np.greater(channel, 0, out=active[class_index])
 
-        np_arrays.append(np_array)
+    highest_active = (num_classes - 1 - np.argmax(active, axis=0)).astype(np.uint8)
 
-    return np.stack(np_arrays, axis=2)
\ No newline at end of file
+    return np.where(active.any(axis=0), highest_active, np.uint8(0))
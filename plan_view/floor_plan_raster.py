@@ -0,0 +1,174 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+
+import cv2
+import numpy as np
+
+from plan_view import svg_parser
+from pupil.atomic import AtomicDirectory, remove_directory
+
+# Floor plans rasterized once and stored next to the SVG, so the per-epoch data
+# path never parses XML:
+#
+#   <floor_plan>.raster/manifest.json     viewBox, size, projection matrices, SVG signature
+#   <floor_plan>.raster/rooms.npy         (H, W) uint16, 1 + index of the room covering a pixel, 0 elsewhere
+#   <floor_plan>.raster/walls.npy         (H, W) uint8, 1 on room outlines
+#   <floor_plan>.raster/obstructions.npy  (H, W) uint8, 1 inside obstructions
+#
+# Pixels are SVG coordinates relative to the viewBox origin, the same frame the
+# projection matrix maps points into. Masks are skipped for floor plans larger
+# than MAX_RASTER_PIXELS, which the pipeline drops anyway. The manifest is
+# written last and marks the raster as complete.
+
+RASTER_VERSION = 1
+
+MANIFEST = "manifest.json"
+
+ROOMS = "rooms"
+WALLS = "walls"
+OBSTRUCTIONS = "obstructions"
+
+MASKS = (ROOMS, WALLS, OBSTRUCTIONS)
+
+MAX_RASTER_PIXELS = 2000 * 1500
+
+MAX_COMMIT_ATTEMPTS = 5
+
+class FloorPlanRaster:
+    def __init__(self, view_box, width, height, inverse_projection_matrix, projection_matrix, masks):
+        self.view_box = view_box
+        self.width = width
+        self.height = height
+        self.inverse_projection_matrix = inverse_projection_matrix
+        self.projection_matrix = projection_matrix
+        self.masks = masks
+
+def raster_dirname(floor_plan_filename):
+    return "{}.raster".format(os.path.splitext(floor_plan_filename)[0])
+
+def _svg_signature(floor_plan_filename):
+    stat = os.stat(floor_plan_filename)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def _pixel_polygons(polygons, view_box):
+    origin = np.array(view_box[0:2], dtype=np.float64)
+
+    return [np.round(np.asarray(polygon, dtype=np.float64) - origin).astype(np.int32) for polygon in polygons if len(polygon) >= 3]
+
+def rasterize_floor_plan(floor_plan, width, height):
+    rooms = np.zeros((height, width), dtype=np.uint16)
+    walls = np.zeros((height, width), dtype=np.uint8)
+    obstructions = np.zeros((height, width), dtype=np.uint8)
+
+    for room_index, room in enumerate(floor_plan.rooms):
+        outlines = _pixel_polygons([room.corners], floor_plan.view_box)
+        if len(outlines) == 0:
+            continue
+
+        cv2.fillPoly(rooms, outlines, room_index + 1)
+        cv2.polylines(walls, outlines, True, 1)
+
+    obstruction_polygons = [polygon for room in floor_plan.rooms for polygon in room.excluded_regions[svg_parser.OBSTRUCTION]]
+    obstruction_outlines = _pixel_polygons(obstruction_polygons, floor_plan.view_box)
+    if len(obstruction_outlines) > 0:
+        cv2.fillPoly(obstructions, obstruction_outlines, 1)
+
+    return {
+        ROOMS: rooms,
+        WALLS: walls,
+        OBSTRUCTIONS: obstructions
+    }
+
+def write_floor_plan_raster(floor_plan_filename):
+    # Returns the manifest of the current raster. Workers may build the same
+    # raster concurrently: the first rename wins and the others use its
+    # manifest. An outdated raster is moved aside and the commit retried, a
+    # current one is never replaced.
+    floor_plan = svg_parser.read_floor_plan_from_file(floor_plan_filename)
+    width, height, inverse_projection_matrix, projection_matrix = svg_parser.get_inverse_projection_matrix(floor_plan.view_box)
+    dirname = raster_dirname(floor_plan_filename)
+
+    with AtomicDirectory(dirname) as directory:
+        has_masks = width * height <= MAX_RASTER_PIXELS
+        if has_masks:
+            for name, mask in rasterize_floor_plan(floor_plan, width, height).items():
+                np.save(os.path.join(directory.path, "{}.npy".format(name)), mask)
+
+        manifest = {
+            "version": RASTER_VERSION,
+            "svg": _svg_signature(floor_plan_filename),
+            "view_box": floor_plan.view_box,
+            "width": width,
+            "height": height,
+            "inverse_projection_matrix": inverse_projection_matrix.tolist(),
+            "projection_matrix": projection_matrix.tolist(),
+            "num_rooms": len(floor_plan.rooms),
+            "has_masks": has_masks
+        }
+
+        with open(os.path.join(directory.path, MANIFEST), "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+
+        for _ in range(MAX_COMMIT_ATTEMPTS):
+            if directory.commit():
+                return manifest
+
+            current_manifest = _load_manifest(floor_plan_filename)
+            if current_manifest is not None:
+                return current_manifest
+
+            remove_directory(dirname)
+
+    raise RuntimeError("Could not commit the raster of {} in {} attempts".format(floor_plan_filename, MAX_COMMIT_ATTEMPTS))
+
+def _load_manifest(floor_plan_filename):
+    manifest_filename = os.path.join(raster_dirname(floor_plan_filename), MANIFEST)
+
+    try:
+        with open(manifest_filename, "r") as manifest_file:
+            manifest = json.load(manifest_file)
+    except FileNotFoundError:
+        return None
+
+    if manifest["version"] != RASTER_VERSION or manifest["svg"] != _svg_signature(floor_plan_filename):
+        return None
+
+    return manifest
+
+def _load_masks(dirname, masks, mmap_mode):
+    return dict((name, np.load(os.path.join(dirname, "{}.npy".format(name)), mmap_mode=mmap_mode)) for name in masks)
+
+def load_floor_plan_raster(floor_plan_filename, masks=MASKS, mmap_mode="r"):
+    # Rasterizes the floor plan on first use, or when the SVG has changed since.
+    dirname = raster_dirname(floor_plan_filename)
+
+    for attempt in range(MAX_COMMIT_ATTEMPTS):
+        manifest = _load_manifest(floor_plan_filename)
+        if manifest is None:
+            manifest = write_floor_plan_raster(floor_plan_filename)
+
+        if not manifest["has_masks"] or len(masks) == 0:
+            loaded_masks = {}
+            break
+
+        try:
+            loaded_masks = _load_masks(dirname, masks, mmap_mode)
+            break
+        except FileNotFoundError:
+            # A concurrent rebuild moved the raster aside between reading
+            # the manifest and the masks.
+            if attempt + 1 == MAX_COMMIT_ATTEMPTS:
+                raise
+
+    return FloorPlanRaster(
+        manifest["view_box"],
+        manifest["width"],
+        manifest["height"],
+        np.array(manifest["inverse_projection_matrix"]),
+        np.array(manifest["projection_matrix"]),
+        loaded_masks
+    )
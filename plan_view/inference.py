@@ -0,0 +1,151 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import time
+
+import numpy as np
+import torch
+
+from plan_view import back_projection, floor_plan_raster
+from plan_view.dataloader import batch_iterator, make_input_sparse_tensor, prepare_example, scene_name
+from plan_view.example_cache import ExampleCache
+from plan_view.prefetch import prefetch
+from pupil import profiler
+from pupil.atomic import atomic_file
+
+# Offline inference over whole datasets. Scenes are prepared in the prefetch
+# workers, packed into batches by the same rules as training (scene count and
+# voxel budget), run through the network without autograd, and split back
+# into per scene predictions:
+#
+#   <output_dir>/<capture_id>/<scene>.predictions.npz
+#       coords       (N, 3) int32    quantized voxel coordinates
+#       predictions  (N,)   uint8    arg max class
+#       confidences  (N,)   float16  softmax probability of the predicted class
+#
+# and, with a back projection mode, the plan-view raster of the scene:
+#
+#   <output_dir>/<capture_id>/<scene>.plan_view.exr
+
+def _inference_mode():
+    # torch.inference_mode where available, it also skips version counting.
+    if hasattr(torch, "inference_mode"):
+        return torch.inference_mode()
+
+    return torch.no_grad()
+
+def predictions_filename(output_dir, example):
+    return os.path.join(output_dir, example.capture_id, "{}.predictions.npz".format(scene_name(example)))
+
+def plan_view_filename(output_dir, example):
+    return os.path.join(output_dir, example.capture_id, "{}.plan_view.exr".format(scene_name(example)))
+
+def write_predictions(filename, coords, logits):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+    probabilities = torch.softmax(logits, dim=1)
+    confidences, predictions = probabilities.max(dim=1)
+
+    # np.savez appends .npz to names without it, so keep it on the temp file.
+    with atomic_file(filename, suffix=".npz") as temp_filename:
+        np.savez(
+            temp_filename,
+            coords=np.asarray(coords, dtype=np.int32),
+            predictions=predictions.numpy().astype(np.uint8),
+            confidences=confidences.numpy().astype(np.float16)
+        )
+
+def load_predictions(filename):
+    with np.load(filename) as predictions_file:
+        return predictions_file["coords"], predictions_file["predictions"], predictions_file["confidences"]
+
+class InferenceStats:
+    def __init__(self):
+        self.start_time = time.time()
+        self.num_scenes = 0
+        self.num_voxels = 0
+        self.num_batches = 0
+
+    def add_batch(self, num_scenes, num_voxels):
+        self.num_batches += 1
+        self.num_scenes += num_scenes
+        self.num_voxels += num_voxels
+
+    def report(self):
+        elapsed = max(time.time() - self.start_time, 1e-6)
+
+        return "{} scenes, {} voxels in {} batches, {:.2f} scenes/s, {:.0f} voxels/s".format(self.num_scenes, self.num_voxels, self.num_batches, self.num_scenes / elapsed, self.num_voxels / elapsed)
+
+class InferenceEngine:
+    def __init__(self, net, device, voxel_size=0.08, batch_size=4, max_voxels_per_batch=400000, num_workers=0, max_pending=None, cache_dir=None):
+        self.net = net.to(device).eval()
+        self.device = device
+        self.voxel_size = voxel_size
+        self.batch_size = batch_size
+        self.max_voxels_per_batch = max_voxels_per_batch
+        self.num_workers = num_workers
+        self.max_pending = max_pending
+        self.cache = ExampleCache(cache_dir) if cache_dir is not None else None
+
+    def _prepared_examples(self, examples):
+        examples = list(examples)
+        prepared_examples = prefetch(prepare_example, ((example, self.voxel_size, self.cache) for example in examples), self.num_workers, self.max_pending)
+
+        # The example rides along as a fourth element, batch_iterator only
+        # looks at the coordinates.
+        for example, prepared_example in zip(examples, prepared_examples):
+            if prepared_example is not None:
+                yield tuple(prepared_example) + (example,)
+
+    def predict(self, examples, stats=None):
+        # Yields (example, coords, logits) per scene, logits on the CPU.
+        stats = stats if stats is not None else InferenceStats()
+
+        for batch in batch_iterator(self._prepared_examples(examples), self.batch_size, self.max_voxels_per_batch):
+            with profiler.span("collate"):
+                input_tensor, _ = make_input_sparse_tensor([prepared_example[0:3] for prepared_example in batch])
+
+            with _inference_mode():
+                with profiler.span("host_to_device", points=input_tensor.F.shape[0]):
+                    input = input_tensor.to(self.device)
+
+                with profiler.span("forward", points=input_tensor.F.shape[0]):
+                    output = self.net(input)
+                    logits = output.F.float().cpu()
+
+            # The last coordinate column is the index of the scene in the batch.
+            coords = output.C.cpu()
+            order = torch.argsort(coords[:, -1])
+            coords = coords[order]
+            logits = logits[order]
+            counts = torch.bincount(coords[:, -1].long(), minlength=len(batch)).tolist()
+
+            stats.add_batch(len(batch), logits.shape[0])
+
+            start = 0
+            for prepared_example, count in zip(batch, counts):
+                yield prepared_example[3], coords[start:start + count, :-1].numpy(), logits[start:start + count]
+                start += count
+
+    def run(self, examples, output_dir, report_interval=10, back_projection_mode=None):
+        stats = InferenceStats()
+        last_report = 0
+
+        for example, coords, logits in self.predict(examples, stats):
+            with profiler.span("write_predictions", points=coords.shape[0]):
+                write_predictions(predictions_filename(output_dir, example), coords, logits)
+
+            if back_projection_mode is not None:
+                with profiler.span("back_projection", points=coords.shape[0]):
+                    raster = floor_plan_raster.load_floor_plan_raster(example.floor_plan.filename, masks=())
+                    back_projection.write_back_projection(plan_view_filename(output_dir, example), coords, logits.numpy(), self.voxel_size, raster.projection_matrix, raster.width, raster.height, back_projection_mode)
+
+            if stats.num_batches - last_report >= report_interval:
+                last_report = stats.num_batches
+                print("Inference: {}".format(stats.report()))
+
+        print("Inference done: {}".format(stats.report()))
+
+        return stats
@@ -0,0 +1,133 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import concurrent.futures
+import os
+import time
+
+import numpy as np
+import open3d
+import pupil_vision
+
+from plan_view import floor_plan_raster, point_cloud_store
+from plan_view.dataloader import DataLoader, Example, filter_by_connected_components, load_merged_point_cloud, min_distances_from_scan_locations
+
+MERGED = "merged"
+EXISTS = "exists"
+SKIPPED = "skipped"
+
+def write_merged_point_cloud(merged_filename, points, intensities, normals, scan_origins, compressed_columns=()):
+    columns = {
+        point_cloud_store.XYZ: points.astype(np.float16),
+        point_cloud_store.INTENSITY: intensities.astype(np.float16),
+        point_cloud_store.NORMALS: normals.astype(np.float16),
+        point_cloud_store.SCAN_DISTANCES: min_distances_from_scan_locations(points, scan_origins)
+    }
+
+    point_cloud_store.write_point_cloud(merged_filename, columns, compressed_columns)
+
+def merge_example(example, compressed_columns=()):
+    example: Example = example
+    merged_filename = example.merged_pointloud
+    start_time = time.time()
+
+    # Rasterizes the floor plan for the data loader as a side effect, also for
+    # scenes merged earlier, so the training workers only ever read rasters.
+    raster = floor_plan_raster.load_floor_plan_raster(example.floor_plan.filename, masks=())
+
+    if point_cloud_store.point_cloud_exists(merged_filename):
+        return merged_filename, EXISTS, 0, time.time() - start_time
+
+    if os.path.exists(merged_filename):
+        # Convert clouds merged in the legacy N x 7 .npy format.
+        scan_origins = [transformation[0:3, 3] for transformation in example.transformations]
+        columns = load_merged_point_cloud(merged_filename, (point_cloud_store.XYZ, point_cloud_store.INTENSITY, point_cloud_store.NORMALS))
+        write_merged_point_cloud(merged_filename, columns[point_cloud_store.XYZ], columns[point_cloud_store.INTENSITY], columns[point_cloud_store.NORMALS], scan_origins, compressed_columns)
+
+        return merged_filename, EXISTS, 0, time.time() - start_time
+
+    os.makedirs(os.path.dirname(merged_filename), exist_ok=True)
+
+    width = raster.width
+    height = raster.height
+
+    if width * height > 2000 * 1500:
+        print("Skipping Florplan, to large ....{} {}".format(width,height))
+        return merged_filename, SKIPPED, 0, time.time() - start_time
+
+    filenames = [scan.filename for scan in example.scans]
+    transformations = example.transformations
+
+    if len(filenames) == 0:
+        return merged_filename, SKIPPED, 0, time.time() - start_time
+
+    points = []
+    intensities = []
+    normals = []
+    scan_origins = []
+
+    for filename, transformation in zip(filenames, transformations):
+        point_cloud = pupil_vision.read_point_cloud(filename)
+        point_cloud.estimate_normals()
+        point_cloud.orient_normals_towards_camera_location(camera_location=np.array([0.0, 0.0, 0.0]))
+        point_cloud.transform(transformation)
+
+        points.append(np.asarray(point_cloud.points))
+        intensities.append(np.asarray(point_cloud.intensities))
+        normals.append(np.asarray(point_cloud.normals))
+
+        scan_origins.append(transformation[0:3, 3])
+
+    point_cloud = open3d.geometry.PointCloud()
+    point_cloud.points = open3d.utility.Vector3dVector(np.concatenate(points, axis=0))
+
+    main_component_mask = filter_by_connected_components(point_cloud, scan_origins)
+
+    np_points = np.concatenate(points, axis=0)[main_component_mask, ...]
+    np_intensities = np.concatenate(intensities, axis=0)[main_component_mask]
+    np_normals = np.concatenate(normals, axis=0)[main_component_mask]
+
+    write_merged_point_cloud(merged_filename, np_points, np_intensities, np_normals, scan_origins, compressed_columns)
+
+    return merged_filename, MERGED, np_points.shape[0], time.time() - start_time
+
+def merge_point_clouds(examples, num_workers=None, compressed_columns=()):
+    num_workers = num_workers if num_workers is not None else os.cpu_count()
+    num_examples = len(examples)
+    num_completed = 0
+    total_points = 0
+    start_time = time.time()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(merge_example, example, compressed_columns) for example in examples]
+
+        for future in concurrent.futures.as_completed(futures):
+            merged_filename, status, num_points, elapsed = future.result()
+            num_completed += 1
+            total_points += num_points
+            elapsed_total = time.time() - start_time
+
+            if status == MERGED:
+                print("[{}/{}] Merged {} points for {} in {:.1f}s ({:.0f} points/s)".format(num_completed, num_examples, num_points, merged_filename, elapsed, num_points / max(elapsed, 1e-6)))
+            elif status == EXISTS:
+                print("[{}/{}] Merged Point Cloud Already exists, skipping {}".format(num_completed, num_examples, merged_filename))
+            else:
+                print("[{}/{}] Skipped {}".format(num_completed, num_examples, merged_filename))
+
+            print("Overall {:.2f} scenes/s, {:.0f} points/s".format(num_completed / max(elapsed_total, 1e-6), total_points / max(elapsed_total, 1e-6)))
+
+    print("Done cnversion of pointclouds to Numpy format")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("execution_id")
+    parser.add_argument("work_dir")
+    parser.add_argument("--num_shards", type=int, default=1)
+    parser.add_argument("--num_workers", type=int, default=None)
+    parser.add_argument("--compressed_columns", nargs="*", default=[])
+    args = parser.parse_args()
+
+    dataloader = DataLoader(args.execution_id, args.work_dir, num_shards=args.num_shards)
+    merge_point_clouds(dataloader.examples, args.num_workers, args.compressed_columns)
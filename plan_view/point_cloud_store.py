@@ -0,0 +1,86 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+
+import numpy as np
+
+from pupil.atomic import AtomicDirectory
+
+# Merged point clouds are stored column by column (structure of arrays) in a
+# directory next to the legacy <scene>.npy:
+#
+#   <capture_id>/<scene>.cloud/manifest.json
+#   <capture_id>/<scene>.cloud/xyz.npy             (N, 3) float16
+#   <capture_id>/<scene>.cloud/intensity.npy       (N,)   float16
+#   <capture_id>/<scene>.cloud/normals.npy         (N, 3) float16
+#   <capture_id>/<scene>.cloud/scan_distances.npy  (N,)   float32
+#
+# Plain columns are memory-mapped on load, compressed columns (.npz) are
+# decompressed on demand. The manifest is written last and marks the cloud as
+# complete.
+
+MANIFEST = "manifest.json"
+
+XYZ = "xyz"
+INTENSITY = "intensity"
+NORMALS = "normals"
+SCAN_DISTANCES = "scan_distances"
+
+def point_cloud_dirname(merged_pointCloud):
+    return "{}.cloud".format(os.path.splitext(merged_pointCloud)[0])
+
+def manifest_filename(merged_pointCloud):
+    return os.path.join(point_cloud_dirname(merged_pointCloud), MANIFEST)
+
+def point_cloud_exists(merged_pointCloud):
+    return os.path.exists(manifest_filename(merged_pointCloud))
+
+def write_point_cloud(merged_pointCloud, columns, compressed_columns=()):
+    # Assemble the columns in a private directory and rename it into place, so
+    # readers never observe a partially written cloud.
+    with AtomicDirectory(point_cloud_dirname(merged_pointCloud), replace=True) as directory:
+        manifest = {"num_points": None, "columns": {}}
+
+        for name, array in columns.items():
+            array = np.ascontiguousarray(array)
+            compressed = name in compressed_columns
+
+            if compressed:
+                np.savez_compressed(os.path.join(directory.path, "{}.npz".format(name)), data=array)
+            else:
+                np.save(os.path.join(directory.path, "{}.npy".format(name)), array)
+
+            manifest["num_points"] = int(array.shape[0])
+            manifest["columns"][name] = {
+                "dtype": array.dtype.str,
+                "shape": list(array.shape),
+                "compressed": compressed
+            }
+
+        with open(os.path.join(directory.path, MANIFEST), "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+
+def load_point_cloud(merged_pointCloud, columns=None, mmap_mode="r"):
+    dirname = point_cloud_dirname(merged_pointCloud)
+
+    with open(os.path.join(dirname, MANIFEST), "r") as manifest_file:
+        manifest = json.load(manifest_file)
+
+    if columns is None:
+        columns = list(manifest["columns"].keys())
+
+    arrays = {}
+    for name in columns:
+        if name not in manifest["columns"]:
+            continue
+
+        if manifest["columns"][name]["compressed"]:
+            with np.load(os.path.join(dirname, "{}.npz".format(name))) as compressed_file:
+                arrays[name] = compressed_file["data"]
+        else:
+            arrays[name] = np.load(os.path.join(dirname, "{}.npy".format(name)), mmap_mode=mmap_mode)
+
+    return arrays
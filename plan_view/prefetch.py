@@ -0,0 +1,69 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import multiprocessing
+
+from pupil import profiler
+
+def _initialize_worker():
+    # Workers only run numpy / MinkowskiEngine quantization, keep them from
+    # oversubscribing the cores the trainer and the other workers are using.
+    import torch
+    torch.set_num_threads(1)
+
+def _call_with_spans(func, args):
+    # Stage spans recorded in a worker travel back with its result and are
+    # merged into the consumer's recorder.
+    recorder = profiler.get_span_recorder()
+    recorder.reset()
+    result = func(*args)
+
+    return result, recorder.snapshot()
+
+def _merge_spans(async_result):
+    result, spans = async_result.get()
+    profiler.get_span_recorder().merge(spans)
+
+    return result
+
+class PrefetchIterator:
+    def __init__(self, func, iterable, num_workers, max_pending=None, start_method=None):
+        self.func = func
+        self.iterable = iterable
+        self.num_workers = num_workers
+        self.max_pending = max_pending if max_pending is not None else 2 * num_workers
+        self.start_method = start_method
+
+    def __iter__(self):
+        context = multiprocessing.get_context(self.start_method)
+        pool = context.Pool(self.num_workers, initializer=_initialize_worker)
+        pending = collections.deque()
+
+        try:
+            # Results are yielded in submission order, so the stream is identical
+            # to the serial one regardless of which worker finishes first. At
+            # most max_pending results are in flight or waiting to be consumed.
+            for args in self.iterable:
+                pending.append(pool.apply_async(_call_with_spans, (self.func, args)))
+
+                if len(pending) >= self.max_pending:
+                    yield _merge_spans(pending.popleft())
+
+            while pending:
+                yield _merge_spans(pending.popleft())
+
+            pool.close()
+        finally:
+            # Reached on exhaustion, on worker errors and when the consumer stops
+            # early (GeneratorExit), so no worker outlives the iterator.
+            pending.clear()
+            pool.terminate()
+            pool.join()
+
+def prefetch(func, iterable, num_workers, max_pending=None, start_method=None):
+    if num_workers <= 0:
+        return (func(*args) for args in iterable)
+
+    return iter(PrefetchIterator(func, iterable, num_workers, max_pending, start_method))
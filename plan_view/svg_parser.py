@@ -2,6 +2,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import re
+
 import numpy as np
 
 from pupil import io
@@ -25,6 +27,8 @@ WINDOW = "window"
 ROOM_MEASUREMENT_GUIDE = "room-measurement-guide"
 INTERFACE_ADJUSTMENT_AREA = "interface_adjustment_area"
 
+SVG_NAMESPACE = "{http://www.w3.org/2000/svg}"
+
 def scale_about_pivot(point, transform_vals):
     effective_scale_x, effective_scale_y, x_pivot, y_pivot = transform_vals
     pivot = np.array([x_pivot, y_pivot, 0], dtype=np.float32).reshape((3, 1))
@@ -69,58 +73,175 @@ def apply_svg_matrix(point, matrix_vals):
     return np.dot(matrix, point)
 
 def convert_points_to_path(points_list):
-    path_str = "M "
+    rounded_points = np.rint(np.asarray(points_list, dtype=np.float64)[:, 0:2]).astype(np.int64)
+    return "M " + " L ".join(["{} {}".format(x, y) for x, y in rounded_points.tolist()]) + " Z"
+
+# Corners of the un-transformed door symbol, as (4, 3) offsets
+RECT_SYMBOL_OFFSETS = np.array([[0, 0, 0], [0, 100, 0], [100, 100, 0], [100, 0, 0]], dtype=np.float64)
+RECT_SYMBOL_PIVOT = np.array([50.0, 50.0, 0.0])
+
+def _effective_scales(matrix_vals, scale):
+    if scale is None:
+        return 1.0, 1.0
+
+    scale_x = np.abs(matrix_vals[0])
+    scale_y = np.abs(matrix_vals[3])
+    min_scale = np.minimum(scale_x, scale_y)
+
+    effective_scale_x = 0.4 * scale / scale_x if scale_x == min_scale else 1.0
+    effective_scale_y = 0.4 * scale / scale_y if scale_y == min_scale else 1.0
+
+    return effective_scale_x, effective_scale_y
+
+def rect_symbol_transform(point, matrix_vals, transform_vals, scale = None):
+    # Composes the chain applied to each symbol corner offset o,
+    #   rotate_about_pivot(apply_svg_matrix(point + scale_about_pivot(o)))
+    # into a single affine map o -> A o + b on 3-vectors.
+    effective_scale_x, effective_scale_y = _effective_scales(matrix_vals, scale)
+    scale_matrix = np.diag([effective_scale_x, effective_scale_y, 1.0])
+
+    svg_matrix = np.array(
+        [
+            [matrix_vals[0], matrix_vals[2], matrix_vals[4]],
+            [matrix_vals[1], matrix_vals[3], matrix_vals[5]],
+            [0, 0, 1]
+        ], dtype=np.float64
+    )
+
+    theta_in_degrees, x_pivot, y_pivot = transform_vals
+    rotation_pivot = np.array([x_pivot, y_pivot, 0.0])
+    cos_theta = np.cos(np.deg2rad(theta_in_degrees))
+    sin_theta = np.sin(np.deg2rad(theta_in_degrees))
+    rotation_matrix = np.array(
+        [
+            [cos_theta, -sin_theta, 0.0],
+            [sin_theta, cos_theta, 0.0],
+            [0.0, 0.0, 1.0]
+        ]
+    )
 
-    for point in points_list[:-1]:
-        path_str = path_str + str(int(round(point[0]))) + " "
-        path_str = path_str + str(int(round(point[1]))) + " "
-        path_str = path_str + "L "
+    rotated_svg_matrix = np.dot(rotation_matrix, svg_matrix)
+    linear = np.dot(rotated_svg_matrix, scale_matrix)
 
-    path_str = path_str + str(int(round(points_list[-1][0]))) + " "
-    path_str = path_str + str(int(round(points_list[-1][1]))) + " "
-    path_str = path_str + "Z"
+    point = np.asarray(point, dtype=np.float64).reshape((3,))
+    offset = np.dot(rotated_svg_matrix, point + RECT_SYMBOL_PIVOT - np.dot(scale_matrix, RECT_SYMBOL_PIVOT))
+    offset = offset + rotation_pivot - np.dot(rotation_matrix, rotation_pivot)
 
-    return path_str
+    return linear, offset
 
 def transform_rect_symbol(point, matrix_vals, transform_vals, scale = None):
-    offsets = [[0, 0], [0, 100], [100, 100], [100, 0]] # offsets is the size of the un-transformed door symbol
-    offsets_npy = [np.array(offset + [0]).reshape((3, 1)) for offset in offsets]
-
-    transformed_corners = []
-    for offset_npy in offsets_npy:
-        if scale is not None:
-            scale_x = np.abs(matrix_vals[0])
-            scale_y = np.abs(matrix_vals[3])
-            min_scale = np.minimum(scale_x, scale_y)
-            if scale_x == min_scale:
-                effective_scale_x = 0.4 * scale / scale_x
-            else:
-                effective_scale_x = 1.0
+    linear, offset = rect_symbol_transform(point, matrix_vals, transform_vals, scale)
+    transformed_corners = np.dot(RECT_SYMBOL_OFFSETS, linear.transpose()) + offset
+
+    return convert_points_to_path(transformed_corners)
 
-            if scale_y == min_scale:
-                effective_scale_y = 0.4 * scale / scale_y
+# SVG path data grammar: the number of arguments per command and, for arcs,
+# which of them are single character flags ("a 25 25 0 1150 50" is legal).
+_PATH_ARGUMENTS = {
+    "M": "nn",
+    "L": "nn",
+    "T": "nn",
+    "H": "n",
+    "V": "n",
+    "C": "nnnnnn",
+    "S": "nnnn",
+    "Q": "nnnn",
+    "A": "nnnffnn",
+    "Z": ""
+}
+
+_PATH_NUMBER = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+_PATH_FLAG = re.compile(r"[01]")
+_PATH_SEPARATORS = re.compile(r"[\s,]*")
+_PATH_COMMANDS = re.compile(r"[MmZzLlHhVvCcSsQqTtAa]")
+_POLYLINE_SEPARATORS = str.maketrans({character: " " for character in "MLZ,"})
+
+def _parse_path_arguments(d_str, pos, command):
+    arguments = []
+
+    for kind in _PATH_ARGUMENTS[command.upper()]:
+        pos = _PATH_SEPARATORS.match(d_str, pos).end()
+        match = (_PATH_FLAG if kind == "f" else _PATH_NUMBER).match(d_str, pos)
+        if match is None:
+            raise ValueError("Malformed path data at {}: {}".format(pos, d_str[pos:pos + 20]))
+
+        arguments.append(float(match.group()))
+        pos = match.end()
+
+    return arguments, pos
+
+def _parse_path_data(d_str):
+    points = []
+    x, y = 0.0, 0.0
+    start_x, start_y = 0.0, 0.0
+    command = None
+    pos = _PATH_SEPARATORS.match(d_str, 0).end()
+
+    while pos < len(d_str):
+        if d_str[pos].isalpha():
+            command = d_str[pos]
+            pos += 1
+
+            if command in "Zz":
+                # Closes the subpath without repeating its first vertex
+                x, y = start_x, start_y
+                command = None
+        elif command is None:
+            raise ValueError("Malformed path data at {}: {}".format(pos, d_str[pos:pos + 20]))
+        else:
+            arguments, pos = _parse_path_arguments(d_str, pos, command)
+            relative = command.islower()
+            upper_command = command.upper()
+
+            if upper_command == "H":
+                x = arguments[0] + (x if relative else 0.0)
+            elif upper_command == "V":
+                y = arguments[0] + (y if relative else 0.0)
             else:
-                effective_scale_y = 1.0
+                # Curves and arcs contribute their end point only
+                x, y = arguments[-2] + (x if relative else 0.0), arguments[-1] + (y if relative else 0.0)
 
-            offset_npy = scale_about_pivot(offset_npy, [effective_scale_x, effective_scale_y, 50.0, 50.0])
+            points.append((x, y))
 
-        symbol_corner = point + offset_npy
-        symbol_corner = apply_svg_matrix(symbol_corner, matrix_vals)
-        symbol_corner = rotate_about_pivot(symbol_corner, transform_vals)
-        transformed_corners.append(symbol_corner.reshape((3,))[:2].tolist())
+            if upper_command == "M":
+                start_x, start_y = x, y
+                # Implicit repeats after a moveto are linetos
+                command = "l" if relative else "L"
 
-    return convert_points_to_path(transformed_corners)
+        pos = _PATH_SEPARATORS.match(d_str, pos).end()
 
-def parse_d_str(d_str):
-    outline = []
+    return np.array(points, dtype=np.float32).reshape((-1, 2))
 
-    if "M" in d_str and "L" in d_str and "Z" in d_str:
-        d_vals = d_str.split(" ")
-        num_corners = int(len(d_vals) // 3)
-        for idx in range(num_corners):
-            outline.append([float(d_vals[3 * idx + 1]), float(d_vals[3 * idx + 2])])
+def parse_path_data(d_str):
+    # Vertices of an SVG path as an (N, 2) float32 array, in absolute
+    # coordinates. Z does not add a closing vertex.
+    commands = set(_PATH_COMMANDS.findall(d_str))
 
-    return outline
+    if commands <= {"M", "L", "Z"}:
+        # Absolute polylines, what the floor plans are made of, are just a
+        # flat list of coordinate pairs. Numbers need no separator between
+        # them ("M-1-2L.5.5"), such data fails float() and goes through the
+        # tokenizer instead.
+        try:
+            values = np.array(list(map(float, d_str.translate(_POLYLINE_SEPARATORS).split())), dtype=np.float32)
+        except ValueError:
+            return _parse_path_data(d_str)
+
+        if values.shape[0] % 2 != 0:
+            raise ValueError("Malformed path data: {}".format(d_str[:40]))
+
+        return values.reshape((-1, 2))
+
+    return _parse_path_data(d_str)
+
+def is_closed_polyline(d_str):
+    return "M" in d_str and "L" in d_str and "Z" in d_str
+
+def parse_d_str(d_str):
+    if is_closed_polyline(d_str):
+        return parse_path_data(d_str)
+
+    return np.zeros((0, 2), dtype=np.float32)
 
 def get_name(room_root):
     for title_candidate in room_root.findall("{http://www.w3.org/2000/svg}title"):
@@ -129,7 +250,7 @@ def get_name(room_root):
     return "Unknown Room"
 
 def get_corners(room_root):
-    outline = []
+    outline = np.zeros((0, 2), dtype=np.float32)
 
     found_titles = []
     for title_candidate in room_root.findall("{http://www.w3.org/2000/svg}title"):
@@ -142,28 +263,21 @@ def get_corners(room_root):
 
         if path.attrib["class"] == WALL:
             if not is_exterior:
-                if "M" in d_str and "L" in d_str and "Z" in d_str:
-                    d_vals = d_str.split(" ")
-                    num_corners = int(len(d_vals) // 3)
-                    for idx in range(num_corners):
-                        outline.append([float(d_vals[3 * idx + 1]), float(d_vals[3 * idx + 2])])
+                if is_closed_polyline(d_str):
+                    outline = parse_path_data(d_str)
                     break
 
     return outline
 
 def get_measurement_guide(info_root):
-    outline = []
+    outline = np.zeros((0, 2), dtype=np.float32)
 
     for path in info_root.findall("{http://www.w3.org/2000/svg}path"):
         d_str = str(path.attrib["d"])
 
         if path.attrib["class"] == ROOM_MEASUREMENT_GUIDE:
-            if "M" in d_str and "L" in d_str and "Z" in d_str:
-                d_vals = d_str.split(" ")
-                num_corners = int(len(d_vals) // 3)
-                for idx in range(num_corners):
-                    outline.append([float(d_vals[3 * idx + 1]), float(d_vals[3 * idx + 2])])
-
+            if is_closed_polyline(d_str):
+                outline = parse_path_data(d_str)
                 break
 
     return outline
@@ -198,6 +312,91 @@ def per_scene_iterator(svg_root):
             else :
                 yield None
 
+class Room:
+    def __init__(self, scene_id, name, corners, excluded_regions):
+        self.scene_id = scene_id
+        self.name = name
+        self.corners = corners
+        self.excluded_regions = excluded_regions
+
+class FloorPlan:
+    def __init__(self, view_box, rooms):
+        self.view_box = view_box
+        self.rooms = rooms
+
+def parse_view_box(svg_attrib):
+    return [float(value) for value in svg_attrib["viewBox"].split(" ")]
+
+def _make_room(room_attrib, titles, paths):
+    # Same results as get_name, get_corners and get_excluded_regions on the
+    # room element, computed from the children collected while streaming.
+    name = titles[0] if len(titles) > 0 else "Unknown Room"
+
+    lower_titles = [title.lower() for title in titles]
+    is_exterior = any(map(lambda x: ("garden" in x and "winter" not in x) or "exterior" in x, lower_titles))
+
+    corners = np.zeros((0, 2), dtype=np.float32)
+    excluded_regions = {
+        INTERFACE_ADJUSTMENT_AREA: [],
+        OBSTRUCTION: []
+    }
+
+    for path_class, d_str in paths:
+        if path_class == WALL:
+            if not is_exterior and len(corners) == 0 and is_closed_polyline(d_str):
+                corners = parse_path_data(d_str)
+        elif path_class in excluded_regions:
+            excluded_regions[path_class].append(parse_d_str(d_str))
+
+    scene_id = room_attrib.get("id") or None
+    return Room(scene_id, name, corners, excluded_regions)
+
+def read_floor_plan(events):
+    # Single pass over iterparse (start, end) events. Only the top-level room
+    # groups and their direct title / path children are looked at, as with
+    # per_scene_iterator, and every top-level subtree is cleared once it has
+    # been consumed so the document is never held in memory as a whole.
+    view_box = None
+    rooms = []
+    stack = []
+    root = None
+    titles = []
+    paths = []
+
+    for event, element in events:
+        if event == "start":
+            if root is None:
+                root = element
+                view_box = parse_view_box(element.attrib)
+
+            stack.append(element)
+            continue
+
+        stack.pop()
+        depth = len(stack)
+
+        if depth == 2 and "room" in stack[1].attrib.get("class", "") and stack[1].tag == SVG_NAMESPACE + "g":
+            if element.tag == SVG_NAMESPACE + "title":
+                titles.append(element.text or "")
+            elif element.tag == SVG_NAMESPACE + "path":
+                paths.append((element.attrib.get("class"), str(element.attrib["d"])))
+        elif depth == 1:
+            if element.tag == SVG_NAMESPACE + "g" and "room" in element.attrib.get("class", ""):
+                rooms.append(_make_room(element.attrib, titles, paths))
+
+            titles = []
+            paths = []
+            element.clear()
+            root.remove(element)
+
+    return FloorPlan(view_box, rooms)
+
+def read_floor_plan_from_file(filename):
+    return read_floor_plan(io.iterparse_svg_from_file(filename))
+
+def read_floor_plan_from_s3(bucket, path):
+    return read_floor_plan(io.iterparse_svg_from_s3(bucket, path))
+
 def translate_polygon(polygon, translation):
     dx, dy = translation
     return [[x + dx, y + dy] for x, y in polygon]
@@ -4,6 +4,7 @@ from __future__ import print_function
 
 import numpy as np
 import open3d
+import os
 import pupil_vision
 
 import MinkowskiEngine as ME
@@ -11,6 +12,7 @@ import MinkowskiEngine.MinkowskiFunctional as MF
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 import torch.utils.tensorboard
 import torchvision
 import matplotlib.pyplot as plt
@@ -25,9 +27,53 @@ from MinkowskiEngine.modules.resnet_block import BasicBlock, Bottleneck
 from torch.optim import Adam, SGD
 
 from plan_view.dataloader import DataLoader
+from plan_view.training_runner import TrainingRunner
 
 from scipy.special import expit
 
+# Residual block stacks whose activations are recomputed in backward instead of
+# kept alive, see MinkUNetBase.checkpoint_blocks.
+CHECKPOINT_NONE = ()
+CHECKPOINT_ENCODER = ("block1", "block2", "block3", "block4")
+CHECKPOINT_DECODER = ("block5", "block6", "block7", "block8")
+CHECKPOINT_ALL = CHECKPOINT_ENCODER + CHECKPOINT_DECODER
+
+def checkpoint_sparse(module, x):
+    # torch.utils.checkpoint only passes tensors, so the module runs on the
+    # features of x and the sparse tensor is rebuilt around them with the same
+    # coords_key and coords_manager. The recomputation in backward therefore
+    # finds the coordinates and kernel maps of the first pass in the manager
+    # instead of building them again. module must keep the tensor stride.
+    out_coords_key = []
+    batch_norms = [child for child in module.modules() if isinstance(child, nn.modules.batchnorm._BatchNorm)]
+
+    def run(features):
+        # The recomputation runs with grad enabled, it must not update the
+        # batch norm running statistics or batch counts a second time.
+        recomputing = torch.is_grad_enabled()
+        momentums = [batch_norm.momentum for batch_norm in batch_norms]
+        num_batches_tracked = [batch_norm.num_batches_tracked.clone() if batch_norm.num_batches_tracked is not None else None for batch_norm in batch_norms]
+        if recomputing:
+            for batch_norm in batch_norms:
+                batch_norm.momentum = 0.0
+
+        try:
+            out = module(ME.SparseTensor(features, coords_key=x.coords_key, coords_manager=x.coords_man))
+        finally:
+            for batch_norm, momentum, count in zip(batch_norms, momentums, num_batches_tracked):
+                batch_norm.momentum = momentum
+                if recomputing and count is not None:
+                    batch_norm.num_batches_tracked.copy_(count)
+
+        if not out_coords_key:
+            out_coords_key.append(out.coords_key)
+
+        return out.F
+
+    features = torch.utils.checkpoint.checkpoint(run, x.F, use_reentrant=True)
+
+    return ME.SparseTensor(features, coords_key=out_coords_key[0], coords_manager=x.coords_man)
+
 class MinkUNetBase(ResNetBase):
     BLOCK = None
     PLANES = None
@@ -39,8 +85,17 @@ class MinkUNetBase(ResNetBase):
     # To use the model, must call initialize_coords before forward pass.
     # Once data is processed, call clear to reset the model before calling
     # initialize_coords
-    def __init__(self, in_channels, out_channels, D=3):
+    def __init__(self, in_channels, out_channels, D=3, checkpoint_blocks=CHECKPOINT_NONE):
         ResNetBase.__init__(self, in_channels, out_channels, D)
+        self.checkpoint_blocks = tuple(checkpoint_blocks)
+
+    def run_block(self, name, x):
+        block = getattr(self, name)
+
+        if name in self.checkpoint_blocks and self.training and torch.is_grad_enabled():
+            return checkpoint_sparse(block, x)
+
+        return block(x)
 
     def network_initialization(self, in_channels, out_channels, D):
         # Output of the first conv concated to conv6
@@ -122,23 +177,23 @@ class MinkUNetBase(ResNetBase):
         out = self.conv1p1s2(out_p1)
         out = self.bn1(out)
         out = self.relu(out)
-        out_b1p2 = self.block1(out)
+        out_b1p2 = self.run_block("block1", out)
 
         out = self.conv2p2s2(out_b1p2)
         out = self.bn2(out)
         out = self.relu(out)
-        out_b2p4 = self.block2(out)
+        out_b2p4 = self.run_block("block2", out)
 
         out = self.conv3p4s2(out_b2p4)
         out = self.bn3(out)
         out = self.relu(out)
-        out_b3p8 = self.block3(out)
+        out_b3p8 = self.run_block("block3", out)
 
         # tensor_stride=16
         out = self.conv4p8s2(out_b3p8)
         out = self.bn4(out)
         out = self.relu(out)
-        out = self.block4(out)
+        out = self.run_block("block4", out)
 
         # tensor_stride=8
         out = self.convtr4p16s2(out)
@@ -146,7 +201,7 @@ class MinkUNetBase(ResNetBase):
         out = self.relu(out)
 
         out = ME.cat((out, out_b3p8))
-        out = self.block5(out)
+        out = self.run_block("block5", out)
 
         # tensor_stride=4
         out = self.convtr5p8s2(out)
@@ -154,7 +209,7 @@ class MinkUNetBase(ResNetBase):
         out = self.relu(out)
 
         out = ME.cat((out, out_b2p4))
-        out = self.block6(out)
+        out = self.run_block("block6", out)
 
         # tensor_stride=2
         out = self.convtr6p4s2(out)
@@ -162,7 +217,7 @@ class MinkUNetBase(ResNetBase):
         out = self.relu(out)
 
         out = ME.cat((out, out_b1p2))
-        out = self.block7(out)
+        out = self.run_block("block7", out)
 
         # tensor_stride=1
         out = self.convtr7p2s2(out)
@@ -170,7 +225,7 @@ class MinkUNetBase(ResNetBase):
         out = self.relu(out)
 
         out = ME.cat((out, out_p1))
-        out = self.block8(out)
+        out = self.run_block("block8", out)
 
         return self.final(out)
 
@@ -254,10 +309,10 @@ if __name__ == '__main__':
     work_dir = "/media/apurvnigam/Storage/tmp/MinkowskiEngine"
     dataloader = DataLoader("9ba730a34e594841a84aeac52eed12d4", work_dir, num_shards=1)
     criterion = nn.CrossEntropyLoss()
-    net = MinkUNet34C(in_channels=5, out_channels=4, D=3)
-
-    model_dict = torch.load("network_iter2090.pth")
-    net.load_state_dict(model_dict)
+    # Recomputing block activations in backward trades compute for memory on
+    # large floor plans, e.g. CHECKPOINT_ENCODER or CHECKPOINT_ALL.
+    checkpoint_blocks = CHECKPOINT_NONE
+    net = MinkUNet34C(in_channels=5, out_channels=4, D=3, checkpoint_blocks=checkpoint_blocks)
 
     # a data loader must return a tuple of coords, features, and labels.
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -265,75 +320,35 @@ if __name__ == '__main__':
     net = net.to(device)
     optimizer = SGD(net.parameters(), lr=1e-2)
 
-    initial_index = 2090
-
-
-
-
-    for index, (input_tensor, label) in enumerate(dataloader.iterator()):
-        index=index+initial_index
-        print("Iteration {}".format(index))
-        torch.cuda.empty_cache()
-        optimizer.zero_grad()
-        #
-        try:
-        #
-             input = input_tensor.to(device)
-             label = label.to(device)
-        #
-        #     # Forward
-             output = net(input)
-        #
-        #
-        #     # if index % 1 == 0:
-        #     #
-        #     #     _, pred = output.F.max(1)
-        #     #     pred = pred.cpu().numpy()
-        #     #     colors = np.array([PUPIL_COLOR_MAP[VALID_CLASS_IDS[l]] for l in pred])
-        #     #     pred_pcd = open3d.geometry.PointCloud()
-        #     #     coordinates = output.C.numpy()[:, :3]  # last column is the batch index
-        #     #     pred_pcd.points = open3d.utility.Vector3dVector(coordinates * 0.02)
-        #     #     pred_pcd.colors = open3d.utility.Vector3dVector(colors / 255)
-        #     #     # vis = open3d.visualization.Visualizer()
-        #     #     # vis.create_window()
-        #     #     open3d.visualization.draw_geometries([pred_pcd])
-        #
-        #         #
-        #         # vis.add_geometry(pred_pcd)
-        #         # vis.update_geometry()
-        #         # vis.poll_events()
-        #         # vis.update_renderer()
-        #         #
-        #         # time.sleepp(2)
-        #         # vis.destroy_window()
-        #     if index%300 ==0:
-        #         torch.save(net.state_dict(), 'network_iter{}.pth'.format(index))
-        #
-        #
-        #         # pred_pcd.points = open3d.Vector3dVector([])
-        #         # pred_pcd.colors = open3d.Vector3dVector([])
-        #         # vis.update_geometry()
-        #         # vis.poll_events()
-        #         # vis.update_renderer()
-        #
-        #
-        #
-        #
-        #     # Loss
-             loss = criterion(output.F, label)
-             print('Iteration: ', index, ', Loss: ', loss.item())
-        #
-        #     # Gradient
-             loss.backward()
-             optimizer.step()
-        #
-        except Exception as e:
-             print("Exception captured")
-             import traceback
-             traceback.print_exc(e)
-             pass
-
-        # Saving and loading a network
-    # torch.save(net.state_dict(), 'test.pth')
-    # net.load_state_dict(torch.load('test.pth'))
-
+    checkpoint_dir = os.path.join(work_dir, "checkpoints")
+    # Used only when checkpoint_dir has no checkpoint to resume from, None
+    # starts from random weights
+    initial_weights = "network_iter2090.pth"
+    checkpoint_interval = 300
+    keep_last_checkpoints = 3
+    num_workers = 4
+    cache_dir = os.path.join(work_dir, "example_cache")
+    batch_size = 4
+    max_voxels_per_batch = 400000
+    stage_report_interval = 100
+    # Opt-in: batches keep their features in float16 on the host and during the
+    # copy to the device, the network itself still computes in float32.
+    half_precision_features = False
+    feature_dtype = torch.float16 if half_precision_features else None
+
+    runner = TrainingRunner(
+        net, optimizer, criterion, dataloader, device, checkpoint_dir,
+        checkpoint_interval=checkpoint_interval,
+        keep_last=keep_last_checkpoints,
+        stage_report_interval=stage_report_interval,
+        iterator_kwargs={
+            "num_workers": num_workers,
+            "cache_dir": cache_dir,
+            "batch_size": batch_size,
+            "max_voxels_per_batch": max_voxels_per_batch,
+            "feature_dtype": feature_dtype
+        }
+    )
+
+    runner.resume(initial_weights)
+    runner.train()
@@ -0,0 +1,246 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import glob
+import os
+import re
+import threading
+import time
+
+import torch
+
+from plan_view.dataloader import input_tensor_to_device
+from pupil import profiler
+from pupil.atomic import atomic_file
+
+# Training loop with restartable state. Checkpoints hold the model, the
+# optimizer, the step and the position of the data stream (see
+# DataLoader.iterator), and are written as
+#
+#   <checkpoint_dir>/checkpoint_<step>.pth
+#
+# The state is copied to host memory on the training thread, torch.save runs
+# in a background thread, and files appear by rename, so the newest file is
+# always complete. Only the last keep_last checkpoints are kept.
+
+CHECKPOINT_PATTERN = re.compile(r"checkpoint_(\d+)\.pth$")
+
+def _copy_to_cpu(state):
+    if torch.is_tensor(state):
+        return state.detach().to("cpu", copy=True)
+    elif isinstance(state, dict):
+        return type(state)((key, _copy_to_cpu(value)) for key, value in state.items())
+    elif isinstance(state, (list, tuple)):
+        return type(state)(_copy_to_cpu(value) for value in state)
+
+    return state
+
+def load_model_state(filename, map_location="cpu"):
+    # Model weights from either a runner checkpoint or a bare state dict
+    state = torch.load(filename, map_location=map_location)
+    if "model" in state and "optimizer" in state:
+        return state["model"]
+
+    return state
+
+def _is_out_of_memory(error):
+    return isinstance(error, RuntimeError) and "out of memory" in str(error)
+
+class CheckpointManager:
+    def __init__(self, checkpoint_dir, keep_last=3):
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = keep_last
+        self.thread = None
+        self.error = None
+
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def checkpoint_filename(self, step):
+        return os.path.join(self.checkpoint_dir, "checkpoint_{:08d}.pth".format(step))
+
+    def checkpoints(self):
+        # (step, filename) of the complete checkpoints, oldest first
+        checkpoints = []
+        for filename in glob.glob(os.path.join(self.checkpoint_dir, "checkpoint_*.pth")):
+            match = CHECKPOINT_PATTERN.search(os.path.basename(filename))
+            if match is not None:
+                checkpoints.append((int(match.group(1)), filename))
+
+        return sorted(checkpoints)
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1][1] if checkpoints else None
+
+    def _write(self, step, state):
+        try:
+            filename = self.checkpoint_filename(step)
+
+            start_time = time.time()
+            with atomic_file(filename) as temp_filename:
+                torch.save(state, temp_filename)
+            print("Saved checkpoint {} in {:.1f}s".format(filename, time.time() - start_time))
+
+            for _, old_filename in self.checkpoints()[:-self.keep_last]:
+                os.remove(old_filename)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, step, state):
+        # At most one save in flight, which bounds the host memory held by
+        # snapshots; a slow disk throttles the training loop instead.
+        self.wait()
+
+        state = _copy_to_cpu(state)
+        self.thread = threading.Thread(target=self._write, args=(step, state), name="checkpoint-writer")
+        self.thread.start()
+
+    def load(self, filename=None, map_location="cpu"):
+        filename = filename if filename is not None else self.latest()
+        if filename is None:
+            return None
+
+        return torch.load(filename, map_location=map_location)
+
+class TrainingRunner:
+    def __init__(self, net, optimizer, criterion, dataloader, device, checkpoint_dir, checkpoint_interval=300, keep_last=3, log_interval=1, stage_report_interval=100, iterator_kwargs=None):
+        self.net = net
+        self.optimizer = optimizer
+        self.criterion = criterion
+        self.dataloader = dataloader
+        self.device = device
+        self.checkpoints = CheckpointManager(checkpoint_dir, keep_last)
+        self.checkpoint_interval = checkpoint_interval
+        self.log_interval = log_interval
+        self.stage_report_interval = stage_report_interval
+        self.iterator_kwargs = iterator_kwargs if iterator_kwargs is not None else {}
+
+        self.step = 0
+        self.position = 0
+        self.skipped_batches = 0
+        self.saved_step = None
+
+    def state(self):
+        state = {
+            "step": self.step,
+            "position": self.position,
+            "skipped_batches": self.skipped_batches,
+            "model": self.net.state_dict(),
+            "optimizer": self.optimizer.state_dict(),
+            "rng": torch.get_rng_state()
+        }
+
+        if torch.cuda.is_available():
+            state["cuda_rng"] = torch.cuda.get_rng_state_all()
+
+        return state
+
+    def load_state(self, state):
+        self.step = state["step"]
+        self.position = state["position"]
+        self.skipped_batches = state.get("skipped_batches", 0)
+        self.net.load_state_dict(state["model"])
+        self.optimizer.load_state_dict(state["optimizer"])
+        torch.set_rng_state(state["rng"])
+
+        if "cuda_rng" in state and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(state["cuda_rng"])
+
+    def resume(self, initial_weights=None):
+        # Continues from the newest checkpoint, otherwise optionally starts
+        # from pretrained weights.
+        state = self.checkpoints.load()
+        if state is not None:
+            self.load_state(state)
+            self.saved_step = self.step
+            print("Resuming from {} at step {}, example {}".format(self.checkpoints.latest(), self.step, self.position))
+        elif initial_weights is not None:
+            self.net.load_state_dict(load_model_state(initial_weights))
+            print("Starting from weights {}".format(initial_weights))
+
+    def save(self):
+        if self.saved_step != self.step:
+            self.checkpoints.save(self.step, self.state())
+            self.saved_step = self.step
+
+    def train_step(self, input_tensor, label):
+        self.optimizer.zero_grad()
+
+        with profiler.span("host_to_device", points=label.shape[0], num_bytes=input_tensor.F.element_size() * input_tensor.F.nelement()):
+            input = input_tensor_to_device(input_tensor, self.device)
+            label = label.to(self.device)
+
+        # loss.item() waits for the device, so the span covers the kernels
+        with profiler.span("forward", points=label.shape[0]):
+            output = self.net(input)
+            loss = self.criterion(output.F, label)
+            loss_value = loss.item()
+
+        with profiler.span("backward", points=label.shape[0]):
+            loss.backward()
+
+        with profiler.span("optimizer_step"):
+            self.optimizer.step()
+
+        return loss_value
+
+    def write_stage_report(self, output_dir):
+        recorder = profiler.get_span_recorder()
+        print(recorder.report())
+        recorder.write_json(os.path.join(output_dir, "stage_timings.json"))
+        recorder.write_csv(os.path.join(output_dir, "stage_timings.csv"))
+
+    def train(self):
+        self.net.train()
+        batches = self.dataloader.iterator(start_position=self.position, with_positions=True, **self.iterator_kwargs)
+        step_start_time = time.time()
+
+        try:
+            for input_tensor, label, position in profiler.span_iterator(batches, "data_wait"):
+                num_voxels = label.shape[0]
+
+                try:
+                    loss_value = self.train_step(input_tensor, label)
+                except RuntimeError as e:
+                    # A scene too large for the device is skipped, anything
+                    # else is a bug and stops the run.
+                    if not _is_out_of_memory(e):
+                        raise
+
+                    del e
+                    self.optimizer.zero_grad()
+                    if torch.cuda.is_available():
+                        torch.cuda.empty_cache()
+
+                    self.skipped_batches += 1
+                    loss_value = None
+                    print("Step {}: out of memory on {} voxels, skipping the batch ({} skipped so far)".format(self.step, num_voxels, self.skipped_batches))
+
+                self.step += 1
+                self.position = position
+
+                elapsed = time.time() - step_start_time
+                step_start_time = time.time()
+
+                if loss_value is not None and self.step % self.log_interval == 0:
+                    print("Step {}, example {}: loss {:.4f}, {} voxels in {:.2f}s ({:.0f} voxels/s)".format(self.step, self.position, loss_value, num_voxels, elapsed, num_voxels / max(elapsed, 1e-6)))
+
+                if self.step % self.checkpoint_interval == 0:
+                    self.save()
+
+                if self.step % self.stage_report_interval == 0:
+                    self.write_stage_report(self.checkpoints.checkpoint_dir)
+
+            self.save()
+        finally:
+            self.checkpoints.wait()
@@ -0,0 +1,106 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import contextlib
+import errno
+import os
+import shutil
+import uuid
+
+# Files and directories that appear complete or not at all. Content is written
+# to a private sibling (same filesystem, unique per writer) and renamed into
+# place:
+#
+#   <path>.tmp-<uuid>   written by one writer, removed if the write fails
+#   <path>.old-<uuid>   a replaced directory, renamed aside before removal
+#
+# Files are committed with os.replace, which atomically swaps any previous
+# version. Directories cannot be swapped that way, so a directory being
+# replaced is first renamed aside and removed from there: a live path is never
+# deleted in place, and readers holding files of the old version (open or
+# memory-mapped) keep them.
+
+TEMP_MARKER = ".tmp-"
+
+def temp_path(path, suffix=""):
+    return "{}{}{}{}".format(path, TEMP_MARKER, uuid.uuid4().hex, suffix)
+
+def is_temp_path(path):
+    return TEMP_MARKER in os.path.basename(path)
+
+@contextlib.contextmanager
+def atomic_file(filename, suffix=""):
+    # Yields the temp filename to write, committed on a clean exit. suffix is
+    # for writers that insist on an extension (np.savez appends .npz).
+    temp_filename = temp_path(filename, suffix)
+
+    try:
+        yield temp_filename
+        os.replace(temp_filename, filename)
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+def remove_directory(dirname):
+    aside_dir = "{}.old-{}".format(dirname, uuid.uuid4().hex)
+
+    try:
+        os.rename(dirname, aside_dir)
+    except FileNotFoundError:
+        return
+
+    shutil.rmtree(aside_dir, ignore_errors=True)
+
+def commit_directory(temp_dir, dirname, replace=False):
+    # Returns False if another writer's directory is at dirname, either from
+    # before (without replace) or committed concurrently.
+    if replace:
+        remove_directory(dirname)
+
+    try:
+        os.rename(temp_dir, dirname)
+    except OSError as error:
+        if error.errno in (errno.EEXIST, errno.ENOTEMPTY):
+            return False
+
+        raise
+
+    return True
+
+class AtomicDirectory:
+    # with AtomicDirectory(dirname) as directory:
+    #     write files into directory.path
+    #
+    # The directory is committed on a clean exit, unless commit() was called
+    # inside the block. directory.committed tells whether dirname now holds
+    # this writer's files. A failed commit() can be retried, e.g. after moving
+    # an outdated directory aside.
+    def __init__(self, dirname, replace=False):
+        self.dirname = dirname
+        self.replace = replace
+        self.path = temp_path(dirname)
+        self.committed = False
+        self.attempted = False
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.dirname)), exist_ok=True)
+        os.makedirs(self.path)
+
+        return self
+
+    def commit(self):
+        self.attempted = True
+        self.committed = commit_directory(self.path, self.dirname, self.replace)
+
+        return self.committed
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None and not self.attempted:
+                self.commit()
+        finally:
+            if os.path.exists(self.path):
+                shutil.rmtree(self.path, ignore_errors=True)
+
+        return False
@@ -0,0 +1,143 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import contextlib
+import fcntl
+import hashlib
+import os
+import time
+
+from pupil.atomic import is_temp_path, temp_path
+
+# Disk-backed, size-bounded cache of S3 objects shared between processes.
+#
+#   <directory>/.lock                  flock'ed shared for reads, exclusive for writes
+#   <directory>/.size                  running estimate of the total size in bytes
+#   <directory>/objects/ab/<sha1>      object content, keyed by bucket, path and ETag
+#
+# An object's mtime is refreshed whenever it is read. Inserts only add to the
+# size estimate; once it exceeds max_bytes, the objects directory is scanned,
+# the least recently used entries are removed down to EVICT_FRACTION of
+# max_bytes, temp files left behind by crashed processes are deleted, and the
+# estimate is reset to the exact total.
+
+EVICT_FRACTION = 0.9
+
+STALE_TEMP_SECONDS = 3600
+
+class S3ObjectCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(directory, "objects")
+        self.lock_filename = os.path.join(directory, ".lock")
+        self.size_filename = os.path.join(directory, ".size")
+
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+    @contextlib.contextmanager
+    def _lock(self, exclusive):
+        with open(self.lock_filename, "a") as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def entry_filename(self, bucket, path, etag):
+        key = hashlib.sha1("{}/{}@{}".format(bucket, path, etag).encode("utf-8")).hexdigest()
+        return os.path.join(self.objects_dir, key[:2], key)
+
+    def _read(self, filename):
+        with self._lock(exclusive=False):
+            if not os.path.exists(filename):
+                return None
+
+            os.utime(filename)
+            with open(filename, "rb") as entry_file:
+                return entry_file.read()
+
+    def get(self, bucket, path, etag, download):
+        # download(filename) must write the object with the given ETag to filename.
+        filename = self.entry_filename(bucket, path, etag)
+
+        data = self._read(filename)
+        if data is not None:
+            return data
+
+        # Download outside the lock into a private temp file, then commit it.
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        temp_filename = temp_path(filename)
+
+        try:
+            download(temp_filename)
+
+            with open(temp_filename, "rb") as entry_file:
+                data = entry_file.read()
+
+            with self._lock(exclusive=True):
+                os.replace(temp_filename, filename)
+
+                total_bytes = self._read_size()
+                total_bytes = total_bytes + len(data) if total_bytes is not None else None
+                if total_bytes is None or total_bytes > self.max_bytes:
+                    total_bytes = self._evict(keep=filename)
+
+                self._write_size(total_bytes)
+        finally:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+
+        return data
+
+    def _read_size(self):
+        # None when missing or unreadable, which forces a scan
+        try:
+            with open(self.size_filename, "r") as size_file:
+                return int(size_file.read())
+        except (OSError, ValueError):
+            return None
+
+    def _write_size(self, total_bytes):
+        with open(self.size_filename, "w") as size_file:
+            size_file.write(str(total_bytes))
+
+    def _evict(self, keep=None):
+        # Returns the total size after eviction.
+        entries = []
+        total_bytes = 0
+        stale_time = time.time() - STALE_TEMP_SECONDS
+
+        for dirpath, _, filenames in os.walk(self.objects_dir):
+            for name in filenames:
+                filename = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(filename)
+                except FileNotFoundError:
+                    continue
+
+                if is_temp_path(name):
+                    # Downloads in flight are recent, older ones were abandoned.
+                    if stat.st_mtime < stale_time:
+                        os.remove(filename)
+                    continue
+
+                entries.append((stat.st_mtime, stat.st_size, filename))
+                total_bytes += stat.st_size
+
+        if total_bytes <= self.max_bytes:
+            return total_bytes
+
+        target_bytes = self.max_bytes * EVICT_FRACTION
+        for _, size, filename in sorted(entries):
+            if total_bytes <= target_bytes:
+                break
+
+            if filename == keep:
+                continue
+
+            os.remove(filename)
+            total_bytes -= size
+
+        return total_bytes
@@ -0,0 +1,299 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import botocore
+import concurrent.futures
+import json
+import os
+import threading
+import time
+
+from pupil.atomic import atomic_file
+from pupil.io import head_object_s3, with_retries
+from pupil.s3 import get_s3_client
+
+# Bulk S3 downloads with ranged, resumable transfers.
+#
+# Each object is downloaded into <filename>.part in parts of part_size bytes
+# (objects below multipart_threshold are a single part). Completed parts are
+# recorded in <filename>.part.json together with the object's ETag, so an
+# interrupted run resumes from the missing parts as long as the object is
+# unchanged. The final filename only appears, by rename, once every part is
+# on disk.
+#
+# Parts are fetched with If-Match on the ETag. An object replaced mid-transfer
+# fails with PreconditionFailed; its partial file is discarded and it is
+# downloaded again from the start, up to MAX_RESTARTS times.
+
+MB = 1024 ** 2
+MAX_RESTARTS = 3
+
+def _is_object_changed(error):
+    return isinstance(error, botocore.exceptions.ClientError) and error.response.get("Error", {}).get("Code") in ("PreconditionFailed", "412")
+
+class TransferStats:
+    def __init__(self, total_files, total_bytes):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.completed_files = 0
+        self.failed_files = 0
+        self.transferred_bytes = 0
+        self.resumed_bytes = 0
+
+    def add_bytes(self, num_bytes):
+        with self.lock:
+            self.transferred_bytes += num_bytes
+
+    def add_resumed_bytes(self, num_bytes):
+        with self.lock:
+            self.resumed_bytes += num_bytes
+
+    def add_file(self, failed=False):
+        with self.lock:
+            if failed:
+                self.failed_files += 1
+            else:
+                self.completed_files += 1
+
+    def throughput(self):
+        return self.transferred_bytes / max(time.time() - self.start_time, 1e-6)
+
+    def report(self):
+        with self.lock:
+            return "{}/{} files, {:.1f}/{:.1f} MB, {:.1f} MB/s{}".format(
+                self.completed_files, self.total_files,
+                (self.resumed_bytes + self.transferred_bytes) / MB, self.total_bytes / MB,
+                self.throughput() / MB,
+                ", {} failed".format(self.failed_files) if self.failed_files else "")
+
+class BandwidthLimiter:
+    def __init__(self, max_bytes_per_second):
+        self.max_bytes_per_second = max_bytes_per_second
+        self.lock = threading.Lock()
+        self.next_time = time.time()
+
+    def acquire(self, num_bytes):
+        if self.max_bytes_per_second is None:
+            return
+
+        # Each chunk reserves its slot on a shared timeline, so the combined
+        # rate of all threads stays under the budget.
+        with self.lock:
+            now = time.time()
+            start_time = max(self.next_time, now)
+            self.next_time = start_time + num_bytes / self.max_bytes_per_second
+
+        if start_time > now:
+            time.sleep(start_time - now)
+
+class _Transfer:
+    def __init__(self, item, size, etag, part_size):
+        self.item = item
+        self.size = size
+        self.etag = etag
+        self.part_size = part_size
+        self.num_parts = max(1, (size + part_size - 1) // part_size)
+        self.lock = threading.Lock()
+        self.completed_parts = set()
+        self.downloaded_bytes = 0
+        self.failed = False
+        self.changed = False
+
+    @property
+    def part_filename(self):
+        return "{}.part".format(self.item.filename)
+
+    @property
+    def state_filename(self):
+        return "{}.part.json".format(self.item.filename)
+
+    def part_range(self, part_index):
+        start = part_index * self.part_size
+        return start, min(start + self.part_size, self.size) - 1
+
+    def load_state(self):
+        if not (os.path.exists(self.part_filename) and os.path.exists(self.state_filename)):
+            return
+
+        with open(self.state_filename, "r") as state_file:
+            state = json.load(state_file)
+
+        if state["etag"] == self.etag and state["size"] == self.size and state["part_size"] == self.part_size:
+            self.completed_parts = set(state["completed_parts"])
+
+    def save_state(self):
+        with atomic_file(self.state_filename) as temp_filename:
+            with open(temp_filename, "w") as state_file:
+                json.dump({
+                    "etag": self.etag,
+                    "size": self.size,
+                    "part_size": self.part_size,
+                    "completed_parts": sorted(self.completed_parts)
+                }, state_file)
+
+    def prepare(self):
+        self.load_state()
+
+        if len(self.completed_parts) == 0:
+            with open(self.part_filename, "wb") as part_file:
+                part_file.truncate(self.size)
+
+            self.save_state()
+
+    def discard(self):
+        for filename in (self.part_filename, self.state_filename):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def missing_parts(self):
+        return [part_index for part_index in range(self.num_parts) if part_index not in self.completed_parts]
+
+    def add_bytes(self, num_bytes):
+        with self.lock:
+            self.downloaded_bytes += num_bytes
+
+    def complete_part(self, part_index):
+        # Returns True for the part that completes the transfer.
+        with self.lock:
+            self.completed_parts.add(part_index)
+            self.save_state()
+
+            return len(self.completed_parts) == self.num_parts and not self.failed
+
+    def commit(self):
+        with open(self.part_filename, "rb+") as part_file:
+            os.fsync(part_file.fileno())
+
+        os.replace(self.part_filename, self.item.filename)
+        os.remove(self.state_filename)
+
+class DownloadManager:
+    def __init__(self, max_workers=16, part_size=32 * MB, multipart_threshold=64 * MB, max_bytes_per_second=None, chunk_size=MB, progress_interval=5.0):
+        self.max_workers = max_workers
+        self.part_size = part_size
+        self.multipart_threshold = multipart_threshold
+        self.chunk_size = chunk_size
+        self.progress_interval = progress_interval
+        self.limiter = BandwidthLimiter(max_bytes_per_second)
+
+    def _describe(self, item):
+        response = head_object_s3(item.bucket, item.path)
+        size = response["ContentLength"]
+        part_size = self.part_size if size >= self.multipart_threshold else max(size, 1)
+
+        return _Transfer(item, size, response["ETag"], part_size)
+
+    def _download_part(self, transfer, part_index, stats):
+        if transfer.changed:
+            # Restarted as a whole, the remaining ranges would fail as well
+            return
+
+        client = get_s3_client()
+        start, end = transfer.part_range(part_index)
+
+        def fetch():
+            if transfer.size == 0:
+                return
+
+            response = client.client.get_object(Bucket=transfer.item.bucket, Key=transfer.item.path, Range="bytes={}-{}".format(start, end), IfMatch=transfer.etag)
+            offset = start
+
+            with open(transfer.part_filename, "rb+") as part_file:
+                body = response["Body"]
+                try:
+                    for chunk in iter(lambda: body.read(self.chunk_size), b""):
+                        self.limiter.acquire(len(chunk))
+                        part_file.seek(offset)
+                        part_file.write(chunk)
+                        offset += len(chunk)
+                        stats.add_bytes(len(chunk))
+                        transfer.add_bytes(len(chunk))
+                finally:
+                    body.close()
+
+            if offset != end + 1:
+                # Retryable, the whole part is fetched again
+                raise botocore.exceptions.IncompleteReadError(actual_bytes=offset - start, expected_bytes=end + 1 - start)
+
+        try:
+            with_retries(fetch)
+        except Exception as error:
+            with transfer.lock:
+                if not transfer.failed:
+                    # A changed object is counted once its restart is settled
+                    transfer.failed = True
+                    transfer.changed = _is_object_changed(error)
+                    if not transfer.changed:
+                        stats.add_file(failed=True)
+            raise
+
+        if transfer.complete_part(part_index):
+            transfer.commit()
+            stats.add_file()
+
+    def download(self, items):
+        items = [item for item in items if item is not None and not os.path.exists(item.filename)]
+
+        for dirname in set(os.path.dirname(item.filename) for item in items):
+            os.makedirs(dirname, exist_ok=True)
+
+        stats = TransferStats(len(items), 0)
+        errors = []
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as thread_pool:
+            for restart in range(MAX_RESTARTS + 1):
+                transfers = list(thread_pool.map(self._describe, items))
+
+                # Largest objects first, so big scans don't straggle at the end.
+                transfers.sort(key=lambda transfer: transfer.size, reverse=True)
+
+                for transfer in transfers:
+                    transfer.prepare()
+
+                stats.total_bytes += sum(transfer.size for transfer in transfers)
+
+                futures = []
+                for transfer in transfers:
+                    missing_parts = transfer.missing_parts()
+                    transfer.downloaded_bytes = transfer.size - sum(transfer.part_range(part_index)[1] - transfer.part_range(part_index)[0] + 1 for part_index in missing_parts)
+                    stats.add_resumed_bytes(transfer.downloaded_bytes)
+
+                    if len(missing_parts) == 0:
+                        transfer.commit()
+                        stats.add_file()
+
+                    for part_index in missing_parts:
+                        futures.append(thread_pool.submit(self._download_part, transfer, part_index, stats))
+
+                pending = set(futures)
+                while pending:
+                    _, pending = concurrent.futures.wait(pending, timeout=self.progress_interval)
+                    print("Downloading: {}".format(stats.report()))
+
+                changed = [transfer for transfer in transfers if transfer.changed]
+                restarting = len(changed) > 0 and restart < MAX_RESTARTS
+                errors.extend(future.exception() for future in futures if future.exception() is not None and not (restarting and _is_object_changed(future.exception())))
+
+                for transfer in changed:
+                    if restarting:
+                        print("s3://{}/{} changed during download, restarting it".format(transfer.item.bucket, transfer.item.path))
+                        transfer.discard()
+                        # Only the bytes already moved remain part of the total
+                        stats.total_bytes -= transfer.size - transfer.downloaded_bytes
+                    else:
+                        stats.add_file(failed=True)
+
+                if not restarting:
+                    break
+
+                items = [transfer.item for transfer in changed]
+
+        print("Downloaded {}".format(stats.report()))
+
+        if errors:
+            raise errors[0]
+
+        return stats
@@ -3,50 +3,36 @@ from __future__ import division
 from __future__ import print_function
 
 import botocore
+import contextlib
 import csv
 import concurrent.futures
 import io
 import json
 import os
+import random
+import time
 import xml.etree.ElementTree as ET
 import xmltodict
 
+from pupil.cache import S3ObjectCache
 from pupil.s3 import get_s3_client
 
-def download_assets(iterable):
-    client = get_s3_client()
-
-    for item in iterable():
-        if item is not None and not os.path.exists(item.filename):
-            dirname = os.path.dirname(item.filename)
-
-            if not os.path.exists(dirname):
-                print("Making directories to {}".format(dirname))
-                os.makedirs(dirname)
-
-    def conditionally_download_item(item):
-        if item is not None and not os.path.exists(item.filename):
-            print("Downloading asset to {}".format(item.filename))
-            client.client.download_file(item.bucket, item.path,item.filename)
-        else:
-            print("Asset {} already exists, skipping download".format(item.filename))
+cache = {}
 
-    thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=min(os.cpu_count() * 2, 24))
-    futures = []
+DEFAULT_S3_CACHE_MAX_BYTES = 10 * 1024 ** 3
 
-    # Download scans in parallel
-    for item in iterable():
-        future = thread_pool.submit(conditionally_download_item, item)
-        futures.append(future)
+def download_assets(iterable, **kwargs):
+    from pupil.download import DownloadManager
 
-    _ = concurrent.futures.wait(futures)
+    return DownloadManager(**kwargs).download(iterable())
 
-    thread_pool.shutdown()
+def head_object_s3(bucket, path):
+    client = get_s3_client()
+    return with_retries(client.client.head_object, Bucket=bucket, Key=path)
 
 def object_exists_s3(bucket, path):
-    client = get_s3_client()
     try:
-        response = client.client.head_object(Bucket=bucket, Key=path)
+        response = head_object_s3(bucket, path)
         return response["ContentLength"] > 0
     except botocore.exceptions.ClientError as error:
         if error.response["Error"]["Code"] == "404":
@@ -71,40 +57,98 @@ def write_json_to_file(filename, json_data, encoder=None):
 def write_json_to_string(json_data):
     return json.dumps(json_data, indent=4, separators=(',', ': '))
 
-def load_json_from_s3(bucket, path):
+_RETRYABLE_ERROR_CODES = set(["500", "502", "503", "504", "InternalError", "RequestTimeout", "SlowDown", "Throttling", "ThrottlingException"])
+
+def _is_retryable(error):
+    if isinstance(error, botocore.exceptions.ClientError):
+        return error.response["Error"]["Code"] in _RETRYABLE_ERROR_CODES
+
+    return isinstance(error, (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError, botocore.exceptions.IncompleteReadError))
+
+def with_retries(func, *args, max_attempts=5, backoff=0.5, **kwargs):
+    for attempt in range(max_attempts):
+        try:
+            return func(*args, **kwargs)
+        except Exception as error:
+            if attempt + 1 == max_attempts or not _is_retryable(error):
+                raise
+
+            # Exponential backoff with full jitter
+            delay = random.uniform(0.0, backoff * (2 ** attempt))
+            print("Retrying after {} (attempt {} of {}, waiting {:.2f}s)".format(error, attempt + 1, max_attempts, delay))
+            time.sleep(delay)
+
+def configure_s3_cache(directory, max_bytes=DEFAULT_S3_CACHE_MAX_BYTES):
+    if directory is None:
+        cache.pop("s3_cache", None)
+    else:
+        cache["s3_cache"] = S3ObjectCache(directory, max_bytes)
+
+def get_s3_cache():
+    # Opt-in through configure_s3_cache or the PUPIL_S3_CACHE_DIR environment variable
+    if "s3_cache" not in cache and os.environ.get("PUPIL_S3_CACHE_DIR"):
+        configure_s3_cache(os.environ["PUPIL_S3_CACHE_DIR"], int(os.environ.get("PUPIL_S3_CACHE_MAX_BYTES", DEFAULT_S3_CACHE_MAX_BYTES)))
+
+    return cache.get("s3_cache")
+
+def _get_object_bytes(bucket, path, etag=None):
     client = get_s3_client()
+    kwargs = {"IfMatch": etag} if etag is not None else {}
+    response = client.client.get_object(Bucket=bucket, Key=path, **kwargs)
+
+    with contextlib.closing(response["Body"]) as body:
+        return body.read()
+
+def _download_object(bucket, path, etag, filename):
+    with io.open(filename, "wb") as output_file:
+        output_file.write(with_retries(_get_object_bytes, bucket, path, etag))
+
+def read_bytes_from_s3(bucket, path):
+    s3_cache = get_s3_cache()
+    if s3_cache is None:
+        return with_retries(_get_object_bytes, bucket, path)
+
+    # Revalidate with a HEAD; a new ETag maps to a new cache entry.
+    etag = head_object_s3(bucket, path)["ETag"]
+    return s3_cache.get(bucket, path, etag, lambda filename: _download_object(bucket, path, etag, filename))
+
+def load_json_from_s3(bucket, path):
+    # json.loads decodes the UTF-8 body bytes itself, no intermediate
+    # BytesIO / TextIOWrapper copies.
+    return json.loads(read_bytes_from_s3(bucket, path))
 
-    s3_bucket = client.s3.Bucket(bucket)
-    s3_object = s3_bucket.Object(path)
+def load_jsons_from_s3(references, max_workers=16):
+    # Fetches all {"bucket": ..., "path": ...} references concurrently and
+    # returns the parsed documents in the order of the references.
+    references = list(references)
+    if len(references) == 0:
+        return []
 
-    with io.BytesIO(s3_object.get()["Body"].read()) as stream:
-        with io.TextIOWrapper(stream, encoding="utf-8") as json_file:
-            return json.load(json_file)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(references))) as thread_pool:
+        futures = [thread_pool.submit(load_json_from_s3, reference["bucket"], reference["path"]) for reference in references]
+
+        return [future.result() for future in futures]
 
 def load_xml_from_file(filename):
     with io.open(filename, "rb") as xml_file:
         return xmltodict.parse(xml_file)
 
 def load_xml_from_s3(bucket, path):
-    client = get_s3_client()
-    s3_bucket = client.s3.Bucket(bucket)
-    s3_object = s3_bucket.Object(path)
-
-    with io.BytesIO(s3_object.get()["Body"].read()) as stream:
-        with io.TextIOWrapper(stream, encoding="utf-8") as xml_file:
-            return xmltodict.parse(xml_file.read())
+    return xmltodict.parse(read_bytes_from_s3(bucket, path).decode("utf-8"))
 
 def load_svg_from_file(filename):
     return ET.parse(filename)
 
 def load_svg_from_s3(bucket, path):
-    client = get_s3_client()
-    s3_bucket = client.s3.Bucket(bucket)
-    s3_object = s3_bucket.Object(path)
-
-    with io.BytesIO(s3_object.get()["Body"].read()) as stream:
+    with io.BytesIO(read_bytes_from_s3(bucket, path)) as stream:
         return ET.parse(stream)
 
+def iterparse_svg_from_file(filename, events=("start", "end")):
+    return ET.iterparse(filename, events=events)
+
+def iterparse_svg_from_s3(bucket, path, events=("start", "end")):
+    return ET.iterparse(io.BytesIO(read_bytes_from_s3(bucket, path)), events=events)
+
 _EXT_METADATA_MAP = {
     ".csv": "text/csv",
     ".exr": "binary/octet-stream",
@@ -2,30 +2,219 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import atexit
+import collections
+import contextlib
 import cProfile
-import io
-import pstats
+import json
+import os
+import sys
+import threading
+import time
+
+from pupil.atomic import atomic_file
+
+# Profiling is selected with environment variables and off by default:
+#
+#   PUPIL_PROFILE=off|cprofile|sample        profiler used by profile / profileable
+#   PUPIL_PROFILE_OUTPUT=<prefix>            output files, <prefix>.<pid>.pstats or .collapsed
+#   PUPIL_PROFILE_INTERVAL=<seconds>         sampling interval, default 0.01
+#   PUPIL_PROFILE_FLUSH_INTERVAL=<seconds>   how often aggregated results are written, default 60
+#
+# "cprofile" traces every call of the profiled functions, aggregated over all
+# calls and dumped in pstats format (python -m pstats, snakeviz). "sample"
+# walks the stacks of the threads inside a profiled call from a background
+# thread, which costs little enough for long training runs, and writes
+# collapsed stacks (flamegraph.pl, speedscope) to <prefix>.<pid>.collapsed
+# plus per function self and total sample counts to <prefix>.<pid>.functions.tsv.
+# Results are flushed periodically and at exit.
+#
+# Independently of the above, span(name) times a named stage (wall and CPU
+# time of the calling thread, plus the points and bytes it processed) and
+# aggregates it per stage for the whole process, for export as JSON or CSV.
+# Spans nest: a stage is charged its exclusive time only, the time of spans
+# opened inside it goes to those stages, so stage totals add up without
+# double counting.
 
 cache = {}
 
-PROFILE_SWITCH = True
+OFF = "off"
+CPROFILE = "cprofile"
+SAMPLE = "sample"
 
 class Profiler:
-    def __init__(self):
+    def __init__(self, output_prefix="pupil_profile", flush_interval=60.0):
         self.profiler = cProfile.Profile()
+        self.output_prefix = output_prefix
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.active_thread = None
+        self.last_flush_time = time.time()
+
+        atexit.register(self.flush)
+
+    @property
+    def filename(self):
+        return "{}.{}.pstats".format(self.output_prefix, os.getpid())
 
     def profile(self, func, *args, **kwargs):
-        self.profiler.enable()
+        # cProfile follows a single thread, nested and concurrent calls run
+        # inside (or next to) the outermost one.
+        with self.lock:
+            owner = self.active_thread is None
+            if owner:
+                self.active_thread = threading.get_ident()
+                self.profiler.enable()
+
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if owner:
+                self.profiler.disable()
+                with self.lock:
+                    self.active_thread = None
+
+                if time.time() - self.last_flush_time > self.flush_interval:
+                    self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.active_thread is not None:
+                return
+
+            self.last_flush_time = time.time()
+            self.profiler.create_stats()
+            if len(self.profiler.stats) > 0:
+                with atomic_file(self.filename) as temp_filename:
+                    self.profiler.dump_stats(temp_filename)
+
+class SamplingProfiler:
+    def __init__(self, output_prefix="pupil_profile", interval=0.01, flush_interval=60.0):
+        self.output_prefix = output_prefix
+        self.interval = interval
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.pid = None
+        self.thread = None
+        self.active_threads = collections.Counter()
+        self.stacks = collections.Counter()
+        self.labels = {}
+        self.num_samples = 0
+
+        atexit.register(self.flush)
+
+    @property
+    def filename(self):
+        return "{}.{}.collapsed".format(self.output_prefix, os.getpid())
+
+    @property
+    def functions_filename(self):
+        return "{}.{}.functions.tsv".format(self.output_prefix, os.getpid())
+
+    def _start(self):
+        # Threads do not survive fork, a forked child starts its own sampler
+        # and aggregates from scratch.
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.active_threads = collections.Counter()
+            self.stacks = collections.Counter()
+            self.num_samples = 0
+            self.thread = threading.Thread(target=self._run, name="pupil-sampling-profiler", daemon=True)
+            self.thread.start()
+
+    def _label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            label = self.labels[code] = "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+        return label
+
+    def _sample(self):
+        frames = sys._current_frames()
+
+        with self.lock:
+            thread_ids = [thread_id for thread_id, depth in self.active_threads.items() if depth > 0]
+
+        stacks = []
+        for thread_id in thread_ids:
+            frame = frames.get(thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+
+            if len(stack) > 0:
+                stacks.append(";".join(reversed(stack)))
+
+        del frames
+
+        with self.lock:
+            for stack in stacks:
+                self.stacks[stack] += 1
+                self.num_samples += 1
+
+    def _run(self):
+        last_flush_time = time.time()
+
+        while True:
+            time.sleep(self.interval)
+            self._sample()
+
+            if time.time() - last_flush_time > self.flush_interval:
+                last_flush_time = time.time()
+                self.flush()
+
+    def profile(self, func, *args, **kwargs):
+        thread_id = threading.get_ident()
+
+        with self.lock:
+            self._start()
+            self.active_threads[thread_id] += 1
+
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.active_threads[thread_id] -= 1
+
+    def function_samples(self, stacks=None):
+        # Per function (self, total) sample counts, aggregated over all calls.
+        self_samples = collections.Counter()
+        total_samples = collections.Counter()
+
+        if stacks is None:
+            with self.lock:
+                stacks = list(self.stacks.items())
+
+        for stack, count in stacks:
+            functions = stack.split(";")
+            self_samples[functions[-1]] += count
+            for function in set(functions):
+                total_samples[function] += count
+
+        return {function: (self_samples[function], total_samples[function]) for function in total_samples}
+
+    def flush(self):
+        with self.lock:
+            if self.num_samples == 0 or self.pid != os.getpid():
+                return
+
+            stacks = list(self.stacks.items())
 
-        result = func(*args, **kwargs)
+        with atomic_file(self.filename) as temp_filename:
+            with open(temp_filename, "w") as collapsed_file:
+                for stack, count in stacks:
+                    collapsed_file.write("{} {}\n".format(stack, count))
 
-        self.profiler.disable()
-        with io.StringIO() as string_stream:
-            profiler_stats = pstats.Stats(self.profiler, stream = string_stream).sort_stats("cumulative")
-            profiler_stats.print_stats()
-            print(string_stream.getvalue())
+        # Hottest functions first, by samples spent in the function itself
+        num_samples = sum(count for _, count in stacks)
+        function_samples = sorted(self.function_samples(stacks).items(), key=lambda item: (-item[1][0], -item[1][1], item[0]))
 
-        return result
+        with atomic_file(self.functions_filename) as temp_filename:
+            with open(temp_filename, "w") as functions_file:
+                functions_file.write("self\ttotal\tself_percent\ttotal_percent\tfunction\n")
+                for function, (self_count, total_count) in function_samples:
+                    functions_file.write("{}\t{}\t{:.2f}\t{:.2f}\t{}\n".format(self_count, total_count, 100.0 * self_count / num_samples, 100.0 * total_count / num_samples, function))
 
 class PassThroughProfiler:
     def __init__(self):
@@ -34,10 +223,26 @@ class PassThroughProfiler:
     def profile(self, func, *args, **kwargs):
         return func(*args, **kwargs)
 
+def profile_mode():
+    mode = os.environ.get("PUPIL_PROFILE", OFF).lower()
+    if mode in ("", "0"):
+        return OFF
+
+    if mode not in (OFF, CPROFILE, SAMPLE):
+        raise ValueError("Unknown PUPIL_PROFILE mode {}, expected one of {}".format(mode, (OFF, CPROFILE, SAMPLE)))
+
+    return mode
+
 def get_profiler():
     if "profiler" not in cache:
-        if PROFILE_SWITCH:
-            cache["profiler"] = Profiler()
+        mode = profile_mode()
+        output_prefix = os.environ.get("PUPIL_PROFILE_OUTPUT", "pupil_profile")
+        flush_interval = float(os.environ.get("PUPIL_PROFILE_FLUSH_INTERVAL", 60.0))
+
+        if mode == CPROFILE:
+            cache["profiler"] = Profiler(output_prefix, flush_interval)
+        elif mode == SAMPLE:
+            cache["profiler"] = SamplingProfiler(output_prefix, float(os.environ.get("PUPIL_PROFILE_INTERVAL", 0.01)), flush_interval)
         else:
             cache["profiler"] = PassThroughProfiler()
 
@@ -52,4 +257,136 @@ def profileable(func):
     def _profile(*args, **kwargs):
         return profile(func, *args, **kwargs)
 
-    return _profile
\ No newline at end of file
+    return _profile
+
+class StageStats:
+    def __init__(self):
+        self.count = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.max_wall_time = 0.0
+        self.points = 0
+        self.num_bytes = 0
+
+    def add(self, count, wall_time, cpu_time, max_wall_time, points, num_bytes):
+        self.count += count
+        self.wall_time += wall_time
+        self.cpu_time += cpu_time
+        self.max_wall_time = max(self.max_wall_time, max_wall_time)
+        self.points += points
+        self.num_bytes += num_bytes
+
+    def values(self):
+        return [self.count, self.wall_time, self.cpu_time, self.max_wall_time, self.points, self.num_bytes]
+
+class Span:
+    def __init__(self, name, points=0, num_bytes=0):
+        self.name = name
+        self.points = points
+        self.num_bytes = num_bytes
+        self.child_wall_time = 0.0
+        self.child_cpu_time = 0.0
+
+    def add(self, points=0, num_bytes=0):
+        # For sizes that are only known once the work is done
+        self.points += int(points)
+        self.num_bytes += int(num_bytes)
+
+class SpanRecorder:
+    COLUMNS = ["stage", "count", "wall_time", "cpu_time", "max_wall_time", "points", "bytes", "mean_wall_time", "points_per_second", "megabytes_per_second"]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = collections.OrderedDict()
+
+    def record(self, name, wall_time, cpu_time, points=0, num_bytes=0):
+        self.merge({name: [1, wall_time, cpu_time, wall_time, points, num_bytes]})
+
+    def snapshot(self):
+        with self.lock:
+            return collections.OrderedDict((name, stats.values()) for name, stats in self.stages.items())
+
+    def merge(self, snapshot):
+        # Adds up stages recorded elsewhere, e.g. the snapshot of a worker process.
+        with self.lock:
+            for name, values in snapshot.items():
+                if name not in self.stages:
+                    self.stages[name] = StageStats()
+
+                self.stages[name].add(*values)
+
+    def reset(self):
+        with self.lock:
+            self.stages = collections.OrderedDict()
+
+    def rows(self):
+        rows = []
+        for name, (count, wall_time, cpu_time, max_wall_time, points, num_bytes) in self.snapshot().items():
+            rows.append([
+                name, count, wall_time, cpu_time, max_wall_time, points, num_bytes,
+                wall_time / max(count, 1),
+                points / max(wall_time, 1e-9),
+                num_bytes / max(wall_time, 1e-9) / 1024 ** 2
+            ])
+
+        return rows
+
+    def report(self):
+        lines = ["{:<24} {:>8} {:>10} {:>10} {:>10} {:>14} {:>10}".format("stage", "count", "wall [s]", "cpu [s]", "mean [ms]", "points/s", "MB/s")]
+        for name, count, wall_time, cpu_time, _, _, _, mean_wall_time, points_per_second, megabytes_per_second in self.rows():
+            lines.append("{:<24} {:>8} {:>10.2f} {:>10.2f} {:>10.1f} {:>14.0f} {:>10.1f}".format(name, count, wall_time, cpu_time, 1000.0 * mean_wall_time, points_per_second, megabytes_per_second))
+
+        return "\n".join(lines)
+
+    def write_json(self, filename):
+        with open(filename, "w") as json_file:
+            json.dump([dict(zip(self.COLUMNS, row)) for row in self.rows()], json_file, indent=2)
+
+    def write_csv(self, filename):
+        from pupil.io import write_to_csv
+        write_to_csv(filename, [self.COLUMNS] + self.rows())
+
+def get_span_recorder():
+    if "span_recorder" not in cache:
+        cache["span_recorder"] = SpanRecorder()
+
+    return cache["span_recorder"]
+
+_open_spans = threading.local()
+
+@contextlib.contextmanager
+def span(name, points=0, num_bytes=0):
+    if not hasattr(_open_spans, "stack"):
+        _open_spans.stack = []
+
+    current_span = Span(name, points, num_bytes)
+    _open_spans.stack.append(current_span)
+    start_wall_time = time.perf_counter()
+    start_cpu_time = time.thread_time()
+
+    try:
+        yield current_span
+    finally:
+        wall_time = time.perf_counter() - start_wall_time
+        cpu_time = time.thread_time() - start_cpu_time
+        _open_spans.stack.pop()
+
+        if _open_spans.stack:
+            parent_span = _open_spans.stack[-1]
+            parent_span.child_wall_time += wall_time
+            parent_span.child_cpu_time += cpu_time
+
+        get_span_recorder().record(name, wall_time - current_span.child_wall_time, cpu_time - current_span.child_cpu_time, current_span.points, current_span.num_bytes)
+
+def span_iterator(iterable, name):
+    # Times how long the consumer waits on each item of iterable.
+    iterator = iter(iterable)
+
+    while True:
+        with span(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+
+        yield item
@@ -3,32 +3,218 @@ from __future__ import division
 from __future__ import print_function
 
 import io
+import os
+import threading
 import boto3
 import uuid
+import weakref
 
 from boto3.s3.transfer import S3Transfer
+from botocore.config import Config
+
+# Sized for the thread pools in pupil.io and pupil.download, so concurrent
+# requests on a shared client reuse connections instead of opening and
+# discarding them when the default pool of 10 is exhausted.
+DEFAULT_MAX_POOL_CONNECTIONS = 32
+
+PROCESS = "process"
+THREAD = "thread"
 
 class S3Client:
-    def __init__(self):
-        self.s3 = boto3.resource("s3")
-        self.client = boto3.client("s3")
+    def __init__(self, max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS, on_request=None):
+        # boto3 sessions are not thread-safe, every client gets its own.
+        session = boto3.session.Session()
+        config = Config(max_pool_connections=max_pool_connections)
+
+        self.s3 = session.resource("s3", config=config)
+        self.client = session.client("s3", config=config)
         self.transfer = S3Transfer(self.client)
 
+        if on_request is not None:
+            self.client.meta.events.register("request-created.s3", on_request)
+            self.s3.meta.client.meta.events.register("request-created.s3", on_request)
+
+    def http_sessions(self):
+        # The botocore HTTP sessions of the low-level client and of the
+        # resource's own client, not exposed publicly by botocore.
+        http_sessions = []
+        for client in (self.client, self.s3.meta.client):
+            http_session = getattr(getattr(client, "_endpoint", None), "http_session", None)
+            if http_session is not None:
+                http_sessions.append(http_session)
+
+        return http_sessions
+
     def close(self):
         del self.s3
         del self.client
         del self.transfer
 
-cache = {}
+def _pool_managers(http_sessions):
+    pool_managers = []
+    for http_session in http_sessions:
+        pool_managers.append(http_session._manager)
+        pool_managers.extend(getattr(http_session, "_proxy_managers", {}).values())
+
+    return pool_managers
+
+def connection_counts(http_sessions):
+    # (HTTP requests, connections opened) summed over the urllib3 pools.
+    num_requests = 0
+    num_connections = 0
+
+    for pool_manager in _pool_managers(http_sessions):
+        for key in list(pool_manager.pools.keys()):
+            pool = pool_manager.pools.get(key)
+            if pool is not None:
+                num_requests += pool.num_requests
+                num_connections += pool.num_connections
+
+    return num_requests, num_connections
+
+class S3ClientRegistry:
+    # Hands out one client per process (the low-level client is thread-safe and
+    # shares its connection pool) or one per thread (needed for resources,
+    # which are not). Clients inherited through fork are dropped in the child,
+    # since their pooled connections are shared with the parent.
+    #
+    # The registry only keeps weak references. A thread's client is released
+    # with the thread, and its connection counts are added to the totals
+    # at that point.
+    def __init__(self, max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS):
+        self.max_pool_connections = max_pool_connections
+        # Reentrant, finalizers run from garbage collection and may fire
+        # while this thread holds the lock.
+        self.lock = threading.RLock()
+        self.fork_resets = 0
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.local = threading.local()
+        self.process_client = None
+        self.clients = weakref.WeakSet()
+        self.clients_created = 0
+        self.client_cache_hits = 0
+        self.api_requests = 0
+        self.released_http_requests = 0
+        self.released_connections = 0
+
+    def after_fork(self):
+        # The lock may have been held by another thread at fork time.
+        self.lock = threading.RLock()
+        self.fork_resets += 1
+        self._reset()
+
+    def _count_request(self, **kwargs):
+        with self.lock:
+            self.api_requests += 1
+
+    def _release(self, pid, http_sessions):
+        # Runs when a client is garbage collected, or on close. Its pools are
+        # cleared so their sockets close now rather than whenever the
+        # connections are collected. Clients inherited through fork are left
+        # alone, their sockets belong to the parent.
+        if pid != os.getpid():
+            return
+
+        num_requests, num_connections = connection_counts(http_sessions)
+        for pool_manager in _pool_managers(http_sessions):
+            pool_manager.clear()
+
+        with self.lock:
+            if pid == self.pid:
+                self.released_http_requests += num_requests
+                self.released_connections += num_connections
+
+    def _create(self):
+        # Called with the lock held
+        client = S3Client(self.max_pool_connections, self._count_request)
+        client.finalizer = weakref.finalize(client, self._release, self.pid, client.http_sessions())
+        self.clients.add(client)
+        self.clients_created += 1
+
+        return client
+
+    def get(self, scope=PROCESS):
+        if self.pid != os.getpid():
+            # Forked without going through os.register_at_fork (e.g. os.fork
+            # called from C code)
+            self.after_fork()
+
+        with self.lock:
+            if scope == THREAD:
+                client = getattr(self.local, "client", None)
+                if client is None:
+                    client = self.local.client = self._create()
+                    return client
+            elif scope == PROCESS:
+                client = self.process_client
+                if client is None:
+                    client = self.process_client = self._create()
+                    return client
+            else:
+                raise ValueError("Unknown S3 client scope {}".format(scope))
+
+            self.client_cache_hits += 1
+            return client
+
+    def stats(self):
+        # api_requests counts S3 calls (botocore request-created events).
+        # http_requests and connections_opened come from the urllib3 pools.
+        # Every HTTP request beyond the first on a connection reused a
+        # pooled connection.
+        with self.lock:
+            clients = list(self.clients)
+            stats = {
+                "pid": self.pid,
+                "clients_created": self.clients_created,
+                "clients_alive": len(clients),
+                "client_cache_hits": self.client_cache_hits,
+                "fork_resets": self.fork_resets,
+                "api_requests": self.api_requests
+            }
+            http_requests = self.released_http_requests
+            connections_opened = self.released_connections
+
+        num_requests, num_connections = connection_counts([http_session for client in clients for http_session in client.http_sessions()])
+        http_requests += num_requests
+        connections_opened += num_connections
+
+        stats["http_requests"] = http_requests
+        stats["connections_opened"] = connections_opened
+        stats["connections_reused"] = http_requests - connections_opened
+        stats["requests_per_connection"] = http_requests / max(connections_opened, 1)
+
+        return stats
+
+    def close(self):
+        with self.lock:
+            clients = list(self.clients)
+
+        for client in clients:
+            client.finalizer()
+            client.close()
+
+        with self.lock:
+            self._reset()
+
+cache = {
+    "registry": S3ClientRegistry()
+}
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=lambda: cache["registry"].after_fork())
+
+def configure_s3_clients(max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS):
+    cache["registry"].close()
+    cache["registry"] = S3ClientRegistry(max_pool_connections)
 
-def get_s3_client():
-    if "client" not in cache:
-        cache["client"] = S3Client()
+def get_s3_client(scope=PROCESS):
+    return cache["registry"].get(scope)
 
-    return cache["client"]
+def get_s3_client_stats():
+    return cache["registry"].stats()
 
 def close_s3_client():
-    if "client" in cache:
-        client = get_s3_client()
-        client.close()
-        del cache["client"]
\ No newline at end of file
+    cache["registry"].close()
@@ -0,0 +1,125 @@
+import collections
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import botocore.exceptions
+
+from pupil import download, io
+from tests.s3_stub import client_error, stub_s3
+
+# Same fields as plan_view.dataloader.Asset
+Asset = collections.namedtuple("Asset", ["bucket", "path", "filename"])
+
+
+class TestDownloadManager(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.data = os.urandom(10 * 1000 + 123)
+        self.asset = Asset("bucket", "scans/scan.bin", os.path.join(self.directory, "scans", "scan.bin"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def manager(self):
+        return download.DownloadManager(max_workers=1, part_size=1000, multipart_threshold=1000, chunk_size=256, progress_interval=60.0)
+
+    def interrupted_download(self, s3):
+        # Part 0 fails with a non-retryable error, the other parts complete.
+        s3.client.put("bucket", self.asset.path, self.data)
+        s3.client.fail_next(client_error("AccessDenied"))
+
+        with self.assertRaises(botocore.exceptions.ClientError):
+            self.manager().download([self.asset])
+
+        self.assertFalse(os.path.exists(self.asset.filename))
+        with open("{}.part.json".format(self.asset.filename), "r") as state_file:
+            self.assertEqual(json.load(state_file)["completed_parts"], list(range(1, 11)))
+
+    def test_download(self):
+        with stub_s3(io, download) as s3:
+            s3.client.put("bucket", self.asset.path, self.data)
+            s3.client.fail_next(client_error("SlowDown"))
+
+            stats = self.manager().download([self.asset])
+
+            self.assertEqual(stats.completed_files, 1)
+            self.assertEqual(s3.client.count("get_object"), 11 + 1)
+
+        with open(self.asset.filename, "rb") as downloaded_file:
+            self.assertEqual(downloaded_file.read(), self.data)
+
+        self.assertFalse(os.path.exists("{}.part".format(self.asset.filename)))
+        self.assertFalse(os.path.exists("{}.part.json".format(self.asset.filename)))
+
+    def test_resume(self):
+        with stub_s3(io, download) as s3:
+            self.interrupted_download(s3)
+
+            stats = self.manager().download([self.asset])
+
+            # Only the missing part is fetched again
+            self.assertEqual(s3.client.count("get_object"), 11 + 1)
+            self.assertEqual(stats.resumed_bytes, len(self.data) - 1000)
+
+        with open(self.asset.filename, "rb") as downloaded_file:
+            self.assertEqual(downloaded_file.read(), self.data)
+
+    def test_restart_when_object_changed(self):
+        with stub_s3(io, download) as s3:
+            self.interrupted_download(s3)
+
+            self.data = self.data[::-1]
+            s3.client.put("bucket", self.asset.path, self.data)
+
+            stats = self.manager().download([self.asset])
+
+            self.assertEqual(s3.client.count("get_object"), 11 + 11)
+            self.assertEqual(stats.resumed_bytes, 0)
+
+        with open(self.asset.filename, "rb") as downloaded_file:
+            self.assertEqual(downloaded_file.read(), self.data)
+
+    def test_restart_when_object_changed_between_ranges(self):
+        with stub_s3(io, download) as s3:
+            s3.client.put("bucket", self.asset.path, self.data)
+            get_object = s3.client.get_object
+            new_data = self.data[::-1]
+
+            def replace_after_third_part(**kwargs):
+                if s3.client.count("get_object") == 3:
+                    s3.client.put("bucket", self.asset.path, new_data)
+
+                return get_object(**kwargs)
+
+            s3.client.get_object = replace_after_third_part
+
+            stats = self.manager().download([self.asset])
+
+            # 3 parts of the old object, the failed fourth, then all 11 again
+            self.assertEqual(s3.client.count("get_object"), 3 + 1 + 11)
+            self.assertEqual(stats.completed_files, 1)
+            self.assertEqual(stats.failed_files, 0)
+            self.assertEqual(stats.transferred_bytes, stats.total_bytes)
+
+        with open(self.asset.filename, "rb") as downloaded_file:
+            self.assertEqual(downloaded_file.read(), new_data)
+
+        self.assertFalse(os.path.exists("{}.part.json".format(self.asset.filename)))
+
+    def test_object_changing_on_every_attempt(self):
+        with stub_s3(io, download) as s3:
+            s3.client.put("bucket", self.asset.path, self.data)
+            s3.client.fail_next(*[client_error("PreconditionFailed")] * (download.MAX_RESTARTS + 1))
+
+            with self.assertRaises(botocore.exceptions.ClientError):
+                self.manager().download([self.asset])
+
+        self.assertFalse(os.path.exists(self.asset.filename))
+
+
+if __name__ == '__main__':
+    unittest.main()
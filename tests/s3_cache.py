@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from unittest import mock
+
+from pupil import cache, io
+from tests.s3_stub import stub_s3
+
+
+class TestS3ObjectCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        io.configure_s3_cache(None)
+        shutil.rmtree(self.directory)
+
+    def test_etag_keyed(self):
+        io.configure_s3_cache(self.directory, max_bytes=1024 ** 2)
+
+        with stub_s3(io) as s3:
+            s3.client.put("bucket", "a.json", b"[1]")
+            self.assertEqual(io.read_bytes_from_s3("bucket", "a.json"), b"[1]")
+            self.assertEqual(io.read_bytes_from_s3("bucket", "a.json"), b"[1]")
+            self.assertEqual(s3.client.count("get_object"), 1)
+
+            # A rewritten object has a new ETag and is fetched again
+            s3.client.put("bucket", "a.json", b"[2]")
+            self.assertEqual(io.read_bytes_from_s3("bucket", "a.json"), b"[2]")
+            self.assertEqual(s3.client.count("get_object"), 2)
+            self.assertEqual(s3.client.count("head_object"), 3)
+
+    def test_evicts_least_recently_used(self):
+        s3_cache = cache.S3ObjectCache(self.directory, max_bytes=1000)
+
+        def download(data):
+            def write(filename):
+                with open(filename, "wb") as entry_file:
+                    entry_file.write(data)
+
+            return write
+
+        for index in range(3):
+            s3_cache.get("bucket", str(index), "etag", download(b"x" * 300))
+
+        # Read 0, so 1 is the least recently used entry
+        old_time = time.time() - 100
+        for index in range(3):
+            os.utime(s3_cache.entry_filename("bucket", str(index), "etag"), (old_time + index, old_time + index))
+        s3_cache.get("bucket", "0", "etag", None)
+
+        with mock.patch("pupil.cache.os.walk", wraps=os.walk) as walk:
+            s3_cache.get("bucket", "3", "etag", download(b"x" * 300))
+            self.assertEqual(walk.call_count, 1)
+
+            remaining = [index for index in range(4) if os.path.exists(s3_cache.entry_filename("bucket", str(index), "etag"))]
+            self.assertEqual(remaining, [0, 2, 3])
+            self.assertEqual(s3_cache._read_size(), 900)
+
+            # Under the budget, inserts only update the estimate
+            s3_cache.get("bucket", "4", "etag", download(b"x" * 50))
+            self.assertEqual(walk.call_count, 1)
+            self.assertEqual(s3_cache._read_size(), 950)
+
+    def test_removes_stale_temp_files(self):
+        s3_cache = cache.S3ObjectCache(self.directory, max_bytes=100)
+        entry_filename = s3_cache.entry_filename("bucket", "a", "etag")
+        os.makedirs(os.path.dirname(entry_filename))
+
+        stale_filename = "{}.tmp-stale".format(entry_filename)
+        recent_filename = "{}.tmp-recent".format(entry_filename)
+        for filename in (stale_filename, recent_filename):
+            with open(filename, "wb") as temp_file:
+                temp_file.write(b"x" * 1000)
+
+        old_time = time.time() - 2 * cache.STALE_TEMP_SECONDS
+        os.utime(stale_filename, (old_time, old_time))
+
+        with open(os.path.join(self.directory, ".size"), "w") as size_file:
+            size_file.write("1000")
+
+        s3_cache.get("bucket", "b", "etag", lambda filename: open(filename, "wb").close())
+
+        self.assertFalse(os.path.exists(stale_filename))
+        self.assertTrue(os.path.exists(recent_filename))
+        self.assertEqual(s3_cache._read_size(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
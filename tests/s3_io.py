@@ -0,0 +1,66 @@
+import json
+import unittest
+
+import botocore.exceptions
+
+from pupil import io
+from tests.s3_stub import client_error, stub_s3
+
+
+class TestLoadJsonsFromS3(unittest.TestCase):
+
+    def setUp(self):
+        io.configure_s3_cache(None)
+
+    def put_documents(self, s3, num_documents):
+        references = []
+        for index in range(num_documents):
+            path = "shards/{}.json".format(index)
+            s3.client.put("bucket", path, json.dumps({"index": index}).encode("utf-8"))
+            references.append({"bucket": "bucket", "path": path})
+
+        return references
+
+    def test_order(self):
+        with stub_s3(io) as s3:
+            references = self.put_documents(s3, 50)
+            documents = io.load_jsons_from_s3(references, max_workers=8)
+
+        self.assertEqual([document["index"] for document in documents], list(range(50)))
+        self.assertEqual(io.load_jsons_from_s3([]), [])
+
+    def test_retries_throttling_and_server_errors(self):
+        with stub_s3(io) as s3:
+            references = self.put_documents(s3, 4)
+            s3.client.fail_next(client_error("SlowDown"), client_error("503"), botocore.exceptions.ConnectionError(error="reset"))
+
+            documents = io.load_jsons_from_s3(references, max_workers=2)
+
+            self.assertEqual([document["index"] for document in documents], list(range(4)))
+            self.assertEqual(s3.client.count("get_object"), 4 + 3)
+
+    def test_gives_up_after_max_attempts(self):
+        with stub_s3(io) as s3:
+            references = self.put_documents(s3, 1)
+            s3.client.fail_next(*[client_error("500") for _ in range(5)])
+
+            with self.assertRaises(botocore.exceptions.ClientError):
+                io.load_jsons_from_s3(references)
+
+            self.assertEqual(s3.client.count("get_object"), 5)
+
+    def test_non_retryable_error(self):
+        with stub_s3(io) as s3:
+            references = self.put_documents(s3, 3)
+            s3.client.fail_next(client_error("AccessDenied"))
+
+            with self.assertRaises(botocore.exceptions.ClientError) as context:
+                io.load_jsons_from_s3(references, max_workers=1)
+
+            self.assertEqual(context.exception.response["Error"]["Code"], "AccessDenied")
+            # Not retried: one failed call, the other references still fetched once
+            self.assertEqual(s3.client.count("get_object"), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import contextlib
+import hashlib
+import io
+import threading
+
+import botocore.exceptions
+
+from unittest import mock
+
+
+# In-memory stand-in for the S3 calls made through pupil.s3.get_s3_client:
+# head_object and get_object (Range, IfMatch), with injectable failures.
+class StubBody:
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def close(self):
+        self.stream.close()
+
+
+def client_error(code, operation_name="GetObject"):
+    return botocore.exceptions.ClientError({"Error": {"Code": code, "Message": code}}, operation_name)
+
+
+class StubS3Client:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.failures = []
+        self.requests = []
+
+    def put(self, bucket, key, data):
+        self.objects[(bucket, key)] = data
+
+    def etag(self, bucket, key):
+        return '"{}"'.format(hashlib.md5(self.objects[(bucket, key)]).hexdigest())
+
+    def fail_next(self, *errors):
+        # Raised in order by the next get_object calls
+        with self.lock:
+            self.failures.extend(errors)
+
+    def _record(self, operation, bucket, key):
+        with self.lock:
+            self.requests.append((operation, bucket, key))
+            if operation == "get_object" and self.failures:
+                raise self.failures.pop(0)
+
+        if (bucket, key) not in self.objects:
+            raise client_error("404" if operation == "head_object" else "NoSuchKey")
+
+    def head_object(self, Bucket, Key):
+        self._record("head_object", Bucket, Key)
+        return {"ContentLength": len(self.objects[(Bucket, Key)]), "ETag": self.etag(Bucket, Key)}
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        self._record("get_object", Bucket, Key)
+
+        if IfMatch is not None and IfMatch != self.etag(Bucket, Key):
+            raise client_error("PreconditionFailed")
+
+        data = self.objects[(Bucket, Key)]
+        if Range is not None:
+            start, end = Range[len("bytes="):].split("-")
+            data = data[int(start):int(end) + 1]
+
+        return {"Body": StubBody(data), "ContentLength": len(data), "ETag": self.etag(Bucket, Key)}
+
+    def count(self, operation, key=None):
+        with self.lock:
+            return sum(1 for request in self.requests if request[0] == operation and (key is None or request[2] == key))
+
+
+class StubS3:
+    # Same shape as pupil.s3.S3Client, only the low-level client is used.
+    def __init__(self):
+        self.client = StubS3Client()
+
+
+@contextlib.contextmanager
+def stub_s3(*modules):
+    # Patches get_s3_client in the given modules (they import it by name) and
+    # makes the retry backoff instant.
+    s3 = StubS3()
+
+    with contextlib.ExitStack() as stack:
+        for module in modules:
+            stack.enter_context(mock.patch.object(module, "get_s3_client", lambda scope=None: s3))
+
+        stack.enter_context(mock.patch("pupil.io.time.sleep"))
+        yield s3
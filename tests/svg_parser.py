@@ -0,0 +1,45 @@
+import unittest
+
+import numpy as np
+
+from plan_view.svg_parser import is_closed_polyline, parse_path_data
+
+
+class TestParsePathData(unittest.TestCase):
+
+    def assertVertices(self, d_str, expected):
+        vertices = parse_path_data(d_str)
+        self.assertEqual(vertices.dtype, np.float32)
+        np.testing.assert_allclose(vertices, np.array(expected, dtype=np.float32).reshape((-1, 2)))
+
+    def test_separated_polyline(self):
+        self.assertVertices("M 1,2 L 3,4 L 5 6 Z", [[1, 2], [3, 4], [5, 6]])
+        self.assertVertices("M1 2L3 4Z", [[1, 2], [3, 4]])
+
+    def test_compact_signs(self):
+        self.assertVertices("M-1-2L3 4Z", [[-1, -2], [3, 4]])
+        self.assertVertices("M10-20L-30+40Z", [[10, -20], [-30, 40]])
+
+    def test_leading_dot_decimals(self):
+        self.assertVertices("M.5.5L1.25.75Z", [[0.5, 0.5], [1.25, 0.75]])
+        self.assertVertices("M-.5-.25L.1,.2Z", [[-0.5, -0.25], [0.1, 0.2]])
+
+    def test_exponents(self):
+        self.assertVertices("M.5.5L1e2-3", [[0.5, 0.5], [100, -3]])
+        self.assertVertices("M1E1+2L-.5-1.5e1Z", [[10, 2], [-0.5, -15]])
+        self.assertVertices("M1e-1 2e+1L3 4Z", [[0.1, 20], [3, 4]])
+
+    def test_relative_commands(self):
+        self.assertVertices("m1 1l2 0v2h-2z", [[1, 1], [3, 1], [3, 3], [1, 3]])
+
+    def test_odd_number_of_values(self):
+        with self.assertRaises(ValueError):
+            parse_path_data("M1 2L3Z")
+
+    def test_is_closed_polyline(self):
+        self.assertTrue(is_closed_polyline("M-1-2L3 4Z"))
+        self.assertFalse(is_closed_polyline("M1 2L3 4"))
+
+
+if __name__ == '__main__':
+    unittest.main()